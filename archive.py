@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+#######################
+# Archive of the old received notifications and sent problems.
+# They are moved out of the database into gzip compressed segment files
+# with one JSON record per line. A segment is rotated when it reaches its
+# size or age limit, and segments older than the retention are deleted.
+# The database keeps an index of the segments of each problem number.
+#######################
+
+SEGMENT_SUFFIX = '.jsonl.gz'
+# Rows moved to the archive at once
+ARCHIVE_BATCH_SIZE = 1000
+
+
+class SegmentArchive(object):
+
+    # Segments are rotated after segment_max_bytes (uncompressed) or segment_max_age seconds
+    # and deleted retention seconds after they were last written
+    def __init__(self, directory, store, segment_max_bytes, segment_max_age, retention):
+        self.directory = directory
+        self.store = store
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.retention = retention
+        self._lock = threading.Lock()
+        self.archived = 0
+        self.pruned = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    # Moves the notifications received before the time (milliseconds) to the archive
+    def archive_notifications(self, received_before):
+        archived = 0
+        while True:
+            rows = self.store.load_archivable_notifications(received_before, ARCHIVE_BATCH_SIZE)
+            if not rows:
+                break
+            segment = self.append('received', [(problem_nr, received, payload)
+                                                for row_id, problem_nr, received, payload in rows])
+            self.store.archive_notifications(rows, segment)
+            archived += len(rows)
+        return self._archived(archived)
+
+    # Moves the closed problems sent before the time (milliseconds) to the archive
+    def archive_problems(self, updated_before):
+        archived = 0
+        while True:
+            rows = self.store.load_archivable_problems(updated_before, ARCHIVE_BATCH_SIZE)
+            if not rows:
+                break
+            segment = self.append('sent', rows)
+            self.store.archive_problems(rows, segment)
+            archived += len(rows)
+        return self._archived(archived)
+
+    def _archived(self, archived):
+        with self._lock:
+            self.archived += archived
+        return archived
+
+    # Appends the records (problem number, time in milliseconds, JSON text) to the current
+    # segment of the kind. Every append is a gzip member of its own, so a segment can be
+    # read while it is written. Returns the name of the segment.
+    def append(self, kind, records):
+        segment = self._get_current_segment(kind)
+        lines = ['{{"problem_nr": {0}, "time": {1}, "record": {2}}}\n'.format(json.dumps(problem_nr), record_time,
+                                                                                record)
+                 for problem_nr, record_time, record in records]
+        data = ''.join(lines).encode('utf-8')
+        with gzip.open(os.path.join(self.directory, segment['name']), 'ab') as f:
+            f.write(data)
+        segment['bytes'] += len(data)
+        self.store.set_value(self._get_segment_key(kind), segment)
+        return segment['name']
+
+    # The segment being written for the kind, a new one if it is full, too old or deleted
+    def _get_current_segment(self, kind):
+        now = time.time()
+        segment = self.store.get_value(self._get_segment_key(kind))
+        if (segment is None or segment['bytes'] >= self.segment_max_bytes or
+                now - segment['created'] >= self.segment_max_age or
+                not os.path.exists(os.path.join(self.directory, segment['name']))):
+            prefix = '{0}-{1}'.format(kind, time.strftime('%Y%m%d-%H%M%S', time.gmtime(now)))
+            name = prefix + SEGMENT_SUFFIX
+            sequence = 0
+            while os.path.exists(os.path.join(self.directory, name)):
+                sequence += 1
+                name = '{0}-{1}{2}'.format(prefix, sequence, SEGMENT_SUFFIX)
+            segment = {'name': name, 'created': now, 'bytes': 0}
+            logging.info("Archive segment %s started", name)
+        return segment
+
+    def _get_segment_key(self, kind):
+        return 'archive_segment_' + kind
+
+    # Archived records ({'problem_nr', 'time', 'record'}) of the problem number, oldest first
+    def find(self, problem_nr):
+        for segment in self.store.find_archive_segments(problem_nr):
+            path = os.path.join(self.directory, segment)
+            if not os.path.exists(path):
+                continue
+            with gzip.open(path, 'rb') as f:
+                for line in f:
+                    entry = json.loads(line.decode('utf-8'))
+                    if entry['problem_nr'] == problem_nr:
+                        yield entry
+
+    # Deletes the segments not written within the retention
+    def prune(self):
+        oldest_allowed = time.time() - self.retention
+        pruned = 0
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(SEGMENT_SUFFIX) and os.path.getmtime(path) < oldest_allowed:
+                os.remove(path)
+                self.store.delete_archive_segment(filename)
+                logging.info("Archive segment %s deleted after the retention", filename)
+                pruned += 1
+        with self._lock:
+            self.pruned += pruned
+        return pruned
+
+    def stats(self):
+        segments = 0
+        size = 0
+        for filename in os.listdir(self.directory):
+            if filename.endswith(SEGMENT_SUFFIX):
+                segments += 1
+                size += os.path.getsize(os.path.join(self.directory, filename))
+        with self._lock:
+            return {'segments': segments, 'size': size, 'archived': self.archived, 'pruned': self.pruned}
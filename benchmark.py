@@ -0,0 +1,561 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+import base64
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from incident import CoprocessPool, IncidentExecutor
+from store import ProblemStore
+
+#######################
+# Benchmarks of the Dynatrace Custom Webhook Integration.
+# They run offline with synthetic problems in a temporary directory,
+# so they can be run on any machine before going to production.
+#######################
+
+# Problems and ranked impacts per problem used by default
+DEFAULT_PROBLEMS = 10000
+DEFAULT_IMPACTS = 5
+
+# Notifications sent to the webhook, per second, and latency (ms) of the fake tenant used by default
+DEFAULT_NOTIFICATIONS = 1000
+DEFAULT_RATE = 100
+DEFAULT_LATENCY = 20
+
+# Threads sending the notifications to the webhook
+SENDERS = 16
+
+# Notifications of the quiet tenant sent during the storm of the noisy tenant (and before it, alone) and their rate
+DEFAULT_QUIET = 50
+QUIET_RATE = 10
+
+# Runs of each command measured by the coldstart benchmark
+DEFAULT_RUNS = 5
+
+# Records sent to the Incident Software and calls made at the same time by the incident benchmark
+DEFAULT_RECORDS = 500
+DEFAULT_PARALLELISM = 4
+
+# Commands started by the coldstart benchmark and the modules a command should only load when needed
+COLDSTART_COMMANDS = (['help'], ['poll'], ['archive'])
+HEAVY_MODULES = ('flask', 'werkzeug', 'jinja2', 'flask_basicauth', 'waitress', 'twilio', 'requests')
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Returns problem details like the ones of the Dynatrace problem API
+def make_problem(nr, impacts=DEFAULT_IMPACTS, status='CLOSED'):
+    start_time = 1500000000000 + nr * 60000
+    return {
+        'id': '{0}_{1}V2'.format(-1000000000000000000 - nr, start_time),
+        'displayName': str(nr),
+        'status': status,
+        'startTime': start_time,
+        'endTime': start_time + 600000 if status == 'CLOSED' else -1,
+        'severityLevel': 'PERFORMANCE',
+        'impactLevel': 'SERVICE',
+        'tagsOfAffectedEntities': [{'context': 'CONTEXTLESS', 'key': 'benchmark'}],
+        'hasRootCause': False,
+        'rankedImpacts': [{
+            'entityId': 'SERVICE-{0:016X}'.format(nr * 100 + i),
+            'entityName': 'Service {0}'.format(i),
+            'severityLevel': 'PERFORMANCE',
+            'impactLevel': 'SERVICE',
+            'eventType': 'SERVICE_RESPONSE_TIME_DEGRADED',
+        } for i in range(impacts)],
+        'rankedEvents': [],
+    }
+
+
+# Problem numbers with '999' are test notifications in the webhook, they are skipped
+def make_problems(count, impacts=DEFAULT_IMPACTS, status='OPEN'):
+    problems = []
+    nr = 0
+    while len(problems) < count:
+        nr += 1
+        if '999' not in str(nr):
+            problems.append(make_problem(nr, impacts, status))
+    return problems
+
+
+# Notification payload sent by Dynatrace for the problem
+def make_notification(problem):
+    return {
+        'ProblemID': problem['displayName'],
+        'PID': problem['id'],
+        'State': problem['status'],
+        'ProblemTitle': 'Response time degradation',
+        'ImpactedEntity': problem['rankedImpacts'][0]['entityName'] if problem['rankedImpacts'] else '',
+        'Tags': 'benchmark',
+    }
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(percentile / 100.0 * (len(values) - 1)))]
+
+
+def get_latencies_as_string(values):
+    return "p50 {0:8.1f} ms, p99 {1:8.1f} ms, max {2:8.1f} ms".format(
+        get_percentile(values, 50) * 1000, get_percentile(values, 99) * 1000, max(values or [0]) * 1000)
+
+
+# Average time of each stage of the pipeline, from the metrics of the webhook
+def print_stages(webhook):
+    print("  Stages (avg):")
+    for stage, histogram in (('get_problem_by_id', webhook.GET_PROBLEM_TIME),
+                             ('incident_call', webhook.INCIDENT_CALL_TIME),
+                             ('comment_post', webhook.COMMENT_POST_TIME),
+                             ('save_request', webhook.SAVE_REQUEST_TIME),
+                             ('persist_problem', webhook.PERSIST_PROBLEM_TIME)):
+        stats = histogram.stats()
+        print("    {0:20}{1:8.1f} ms ({2} calls)".format(stage, stats['avg'] * 1000, stats['count']))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Local stand-in for the problem details, problem feed and comments endpoints of
+# the Dynatrace API. Every answer is delayed by the latency (seconds). The time
+# of the first comment of each problem is recorded as the end of its integration.
+class FakeTenant(object):
+
+    def __init__(self, problems, latency):
+        self.problems = dict((problem['id'], problem) for problem in problems)
+        self.latency = latency
+        self.commented = {}
+        self.requests = 0
+        self._condition = threading.Condition()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._get_handler())
+        self._thread = None
+
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-tenant')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # Waits until the problems are commented. Returns the problems commented.
+    def wait_for_comments(self, count, timeout):
+        deadline = timeit.default_timer() + timeout
+        with self._condition:
+            while len(self.commented) < count:
+                remaining = deadline - timeit.default_timer()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return len(self.commented)
+
+    def _comment(self, problem_id):
+        with self._condition:
+            if problem_id not in self.commented:
+                self.commented[problem_id] = timeit.default_timer()
+                self._condition.notify_all()
+
+    def _get_handler(self):
+        tenant = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, Nagle would delay the body of the keep-alive answers
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                tenant._wait()
+                path = self.path.split('?')[0]
+                if path.startswith('/api/v1/problem/feed/'):
+                    self._answer(200, {'result': {
+                        'problems': list(tenant.problems.values()),
+                        'monitored': {'APPLICATION': 10, 'SERVICE': 100, 'INFRASTRUCTURE': 1000}}})
+                elif path.startswith('/api/v1/problem/details/') and path[24:] in tenant.problems:
+                    self._answer(200, {'result': tenant.problems[path[24:]]})
+                else:
+                    self._answer(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                tenant._wait()
+                path = self.path.split('?')[0]
+                if path.startswith('/api/v1/problem/details/') and path.endswith('/comments'):
+                    tenant._comment(path[24:-len('/comments')])
+                    self._answer(200, {})
+                else:
+                    self._answer(404, {'error': {'code': 404, 'message': 'Not found'}})
+
+            def _answer(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _wait(self):
+        with self._condition:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+# Imports the webhook with the configuration of the repository pointing to the
+# fake tenant. The database and the logs are written in the working directory,
+# the incident software is a no-op command and the comments are posted at once.
+def load_webhook(tenant_url, workdir, tenants=()):
+    write_config(tenant_url, workdir, tenants)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        sys.path.insert(0, BENCHMARK_DIR)
+        import webhook
+    finally:
+        os.chdir(cwd)
+    logging.getLogger().setLevel(logging.WARNING)
+    return webhook
+
+
+def write_config(tenant_url, workdir, tenants=()):
+    with open(os.path.join(BENCHMARK_DIR, 'config.json')) as f:
+        config = json.load(f)
+    config['dynatrace']['tenant'] = tenant_url
+    # The fake tenant has no rate limit
+    config['dynatrace']['rate_limit'] = 0
+    config['store_file'] = os.path.join(workdir, 'webhook.db')
+    config['log_dir'] = os.path.join(workdir, 'log')
+    config['comments']['window'] = 0
+    config['incident_notification']['active'] = True
+    config['incident_notification']['exec_unix'] = 'true'
+    config['incident_notification']['exec_win'] = 'cmd /c exit 0'
+    config['sms_notification']['active'] = False
+    config['poll']['in_webserver'] = False
+    config['tenants'] = list(tenants)
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f)
+
+
+def get_headers(username, password):
+    credentials = '{0}:{1}'.format(username, password).encode('utf-8')
+    return {'Authorization': 'Basic ' + base64.b64encode(credentials).decode('ascii'),
+            'Content-Type': 'application/json'}
+
+
+# Posts the notifications of the problems to the path, rate per second (0 = all at once).
+# Returns the time each problem was sent, the latencies of the answers and their count by HTTP status.
+def send_notifications(client, path, headers, problems, rate):
+    sent_at = {}
+    ack_latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def send(problem):
+        payload = json.dumps(make_notification(problem))
+        started_at = timeit.default_timer()
+        response = client.post(path, data=payload, headers=headers)
+        acked_at = timeit.default_timer()
+        with lock:
+            sent_at[problem['id']] = started_at
+            ack_latencies.append(acked_at - started_at)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    pool = ThreadPoolExecutor(max_workers=SENDERS)
+    started_at = timeit.default_timer()
+    for i, problem in enumerate(problems):
+        delay = started_at + float(i) / rate - timeit.default_timer() if rate else 0
+        if delay > 0:
+            time.sleep(delay)
+        pool.submit(send, problem)
+    pool.shutdown(wait=True)
+    return sent_at, ack_latencies, statuses
+
+
+# Notifications are sent to handle_post at the given rate (per second). The ack
+# latency is the answer of the webhook, the end-to-end latency lasts until the
+# problem is commented in the fake tenant (details fetched, incident software called).
+def benchmark_throughput(notifications, rate, impacts, latency):
+    workdir = tempfile.mkdtemp(prefix='webhook-benchmark-')
+    problems = make_problems(notifications, impacts)
+    tenant = FakeTenant(problems, latency / 1000.0)
+    tenant.start()
+    try:
+        webhook = load_webhook(tenant.url(), workdir)
+        webhook.INGEST_QUEUE.start()
+        client = webhook.get_app().test_client()
+        print("Throughput with {0} notifications at {1}/s, {2} impacts per problem, tenant latency {3} ms:".format(
+            notifications, rate, impacts, latency))
+        started_at = timeit.default_timer()
+        sent_at, ack_latencies, statuses = send_notifications(
+            client, '/', get_headers(webhook.USERNAME, webhook.PASSWORD), problems, rate)
+        sent_in = timeit.default_timer() - started_at
+
+        commented = tenant.wait_for_comments(statuses.get(200, 0), 60 + notifications * latency / 1000.0)
+        finished_in = max(tenant.commented.values() or [started_at]) - started_at
+        end_to_end = [tenant.commented[pid] - sent_at[pid] for pid in tenant.commented if pid in sent_at]
+        print("  Answers:            {0}".format(', '.join('HTTP {0}: {1}'.format(status, count)
+                                                         for status, count in sorted(statuses.items()))))
+        print("  Sent in:            {0:8.2f} s ({1:.0f} notifications/s)".format(sent_in, notifications / sent_in))
+        print("  Ack latency:        {0}".format(get_latencies_as_string(ack_latencies)))
+        print("  End-to-end latency: {0}".format(get_latencies_as_string(end_to_end)))
+        print("  Integrated:         {0} in {1:.2f} s ({2:.0f} notifications/s), {3} calls to the tenant".format(
+            commented, finished_in, commented / finished_in if finished_in else 0, tenant.requests))
+        print_stages(webhook)
+    finally:
+        tenant.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# A noisy tenant sends a storm of notifications at once while a quiet tenant, served by
+# the same webhook, keeps sending notifications at QUIET_RATE. The end-to-end latency of
+# the quiet tenant is measured alone and during the storm.
+def benchmark_tenants(notifications, quiet, latency):
+    workdir = tempfile.mkdtemp(prefix='webhook-benchmark-')
+    noisy_tenant = FakeTenant(make_problems(notifications, DEFAULT_IMPACTS), latency / 1000.0)
+    quiet_problems = make_problems(2 * quiet, DEFAULT_IMPACTS)
+    quiet_tenant = FakeTenant(quiet_problems, latency / 1000.0)
+    noisy_tenant.start()
+    quiet_tenant.start()
+    try:
+        webhook = load_webhook(noisy_tenant.url(), workdir, [{
+            'name': 'quiet', 'tenant': quiet_tenant.url(), 'api_token': 'quiet-token', 'username': 'quiet',
+            'password': 'quiet-s3cr3t', 'rate_limit': 0}])
+        for tenant in webhook.TENANTS:
+            tenant.ingest_queue.start()
+        client = webhook.get_app().test_client()
+        quiet_headers = get_headers('quiet', 'quiet-s3cr3t')
+        print("Storm of {0} notifications of a noisy tenant, {1} notifications at {2}/s of a quiet tenant, "
+              "tenant latency {3} ms:".format(notifications, quiet, QUIET_RATE, latency))
+
+        sent_alone, _, _ = send_notifications(client, '/tenant/quiet', quiet_headers, quiet_problems[:quiet],
+                                              QUIET_RATE)
+        quiet_tenant.wait_for_comments(quiet, 60)
+        alone = [quiet_tenant.commented[pid] - sent_alone[pid] for pid in sent_alone if pid in quiet_tenant.commented]
+
+        storm = {}
+        started_at = timeit.default_timer()
+        storm_thread = threading.Thread(target=lambda: storm.update(answers=send_notifications(
+            client, '/', get_headers(webhook.USERNAME, webhook.PASSWORD), list(noisy_tenant.problems.values()), 0)))
+        storm_thread.start()
+        sent_storm, _, _ = send_notifications(client, '/tenant/quiet', quiet_headers, quiet_problems[quiet:],
+                                              QUIET_RATE)
+        storm_thread.join()
+        quiet_tenant.wait_for_comments(2 * quiet, 60)
+        during = [quiet_tenant.commented[pid] - sent_storm[pid] for pid in sent_storm
+                  if pid in quiet_tenant.commented]
+        statuses = storm['answers'][2]
+        commented = noisy_tenant.wait_for_comments(statuses.get(200, 0), 60 + notifications * latency / 1000.0)
+        finished_in = max(noisy_tenant.commented.values() or [started_at]) - started_at
+
+        print("  Quiet tenant alone:        {0}".format(get_latencies_as_string(alone)))
+        print("  Quiet tenant in the storm: {0}".format(get_latencies_as_string(during)))
+        print("  Noisy tenant answers:      {0}".format(', '.join('HTTP {0}: {1}'.format(status, count)
+                                                                for status, count in sorted(statuses.items()))))
+        print("  Noisy tenant integrated:   {0} in {1:.2f} s ({2:.0f} notifications/s)".format(
+            commented, finished_in, commented / finished_in if finished_in else 0))
+    finally:
+        noisy_tenant.stop()
+        quiet_tenant.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Poll of the problem feed of the fake tenant, all the problems are new
+def benchmark_poll(problems, impacts, latency):
+    workdir = tempfile.mkdtemp(prefix='webhook-benchmark-')
+    tenant = FakeTenant(make_problems(problems, impacts), latency / 1000.0)
+    tenant.start()
+    try:
+        webhook = load_webhook(tenant.url(), workdir)
+        print("Poll of {0} new problems, {1} impacts per problem, tenant latency {2} ms:".format(
+            problems, impacts, latency))
+        started_at = timeit.default_timer()
+        webhook.poll_problems(webhook.RELATIVETIMES[0])
+        polled_in = timeit.default_timer() - started_at
+        commented = tenant.wait_for_comments(problems, 60 + problems * latency / 1000.0)
+        finished_in = max(tenant.commented.values() or [started_at]) - started_at
+        print("  Polled in:          {0:8.2f} s ({1:.0f} problems/s)".format(polled_in, problems / polled_in))
+        print("  Integrated:         {0} in {1:.2f} s ({2:.0f} problems/s), {3} calls to the tenant".format(
+            commented, finished_in, commented / finished_in if finished_in else 0, tenant.requests))
+        print_stages(webhook)
+    finally:
+        tenant.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def measure(function, repeat=3):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+# Time needed to load the sent problems at startup: the compact index of the
+# database against decoding all the details and the JSON files of previous versions.
+def benchmark_startup(problems):
+    workdir = tempfile.mkdtemp(prefix='webhook-benchmark-')
+    try:
+        dir_sent = os.path.join(workdir, 'problems_sent')
+        os.makedirs(dir_sent)
+        details = [make_problem(nr) for nr in range(problems)]
+        for problem in details:
+            with open(os.path.join(dir_sent, problem['displayName'] + '.json'), 'w') as f:
+                json.dump(problem, f)
+        store = ProblemStore(os.path.join(workdir, 'webhook.db'))
+        store.save_problems(details)
+
+        def load_json_files():
+            loaded = {}
+            for filename in os.listdir(dir_sent):
+                with open(os.path.join(dir_sent, filename), 'r') as f:
+                    problem = json.load(f)
+                    loaded[problem['displayName']] = problem
+            return loaded
+
+        def load_details():
+            return dict((p['displayName'], p) for p in store.find_problems())
+
+        def load_index():
+            return dict((row[0], row) for row in store.load_index())
+
+        print("Startup with {0} sent problems:".format(problems))
+        print("  JSON files (listdir + json.load): {0:8.1f} ms".format(measure(load_json_files) * 1000))
+        print("  Database, full details:           {0:8.1f} ms".format(measure(load_details) * 1000))
+        print("  Database, compact index:          {0:8.1f} ms".format(measure(load_index) * 1000))
+        store.close()
+    finally:
+        shutil.rmtree(workdir)
+
+
+# Wall time of new interpreters running the commands of webhook.py (as a cron job
+# would), and the heavy modules loaded by importing the webhook without a command.
+def benchmark_coldstart(runs):
+    workdir = tempfile.mkdtemp(prefix='webhook-benchmark-')
+    tenant = FakeTenant(make_problems(10), 0)
+    tenant.start()
+    try:
+        write_config(tenant.url(), workdir)
+        script = os.path.join(BENCHMARK_DIR, 'webhook.py')
+        print("Cold start of webhook.py, best of {0} runs:".format(runs))
+        for arguments in COLDSTART_COMMANDS:
+            elapsed = measure(lambda: subprocess.check_call([sys.executable, script] + arguments, cwd=workdir,
+                                                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL),
+                              runs)
+            print("  {0:30} {1:8.1f} ms".format(' '.join(['webhook.py'] + arguments), elapsed * 1000))
+        code = ("import sys, timeit; sys.path.insert(0, {0!r}); started_at = timeit.default_timer(); import webhook; "
+                "print(timeit.default_timer() - started_at); "
+                "print(' '.join(m for m in {1!r} if m in sys.modules))").format(BENCHMARK_DIR, HEAVY_MODULES)
+        imported_in, loaded = subprocess.check_output([sys.executable, '-c', code], cwd=workdir,
+                                                      stderr=subprocess.DEVNULL).decode('utf-8').splitlines()
+        print("  {0:30} {1:8.1f} ms".format('import webhook', float(imported_in) * 1000))
+        print("  Heavy modules loaded by the import: {0}".format(loaded or 'none'))
+    finally:
+        tenant.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Calls of the sample legacy script: a process per record (spawn) against the
+# long-lived workers of the coprocess mode. The output of the script is discarded.
+def benchmark_incident(records, parallelism):
+    if os.name == 'nt':
+        print("The incident benchmark calls the Linux sample scripts")
+        return
+    import resource
+    problem = make_problem(0, records)
+    argument_list = ["Problem [{0}]: Status={1} Entity details: Entity={2}, impactLevel={3}".format(
+        problem['displayName'], problem['status'], impact['entityName'], impact['impactLevel'])
+        for impact in problem['rankedImpacts']]
+    script = os.path.join(BENCHMARK_DIR, 'legacy_script.sh')
+    worker = os.path.join(BENCHMARK_DIR, 'legacy_script_worker.sh')
+    print("Incident Software called for {0} records, {1} calls at the same time:".format(records, parallelism))
+    for mode in ('spawn', 'coprocess'):
+        pool = CoprocessPool('/bin/sh ' + worker, parallelism, 60) if mode == 'coprocess' else None
+        executor = IncidentExecutor('/bin/sh ' + script, parallelism, 60, pool=pool)
+        cpu_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        output = os.dup(1), os.dup(2)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        try:
+            started_at = timeit.default_timer()
+            return_codes = [return_code for _, return_code in executor.call_all(argument_list)]
+            elapsed = timeit.default_timer() - started_at
+            executor.shutdown()
+        finally:
+            os.dup2(output[0], 1)
+            os.dup2(output[1], 2)
+            for fd in output + (devnull,):
+                os.close(fd)
+        cpu_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (cpu_after.ru_utime - cpu_before.ru_utime) + (cpu_after.ru_stime - cpu_before.ru_stime)
+        print("  {0:10} {1:8.2f} s ({2:6.0f} records/s), CPU of the processes {3:6.2f} s, failed {4}".format(
+            mode, elapsed, records / elapsed, cpu, sum(1 for return_code in return_codes if return_code)))
+
+
+def get_usage_as_string():
+    return """
+Dynatrace Custom Webhook Integration - Benchmarks
+=======================================================
+Usage: benchmark.py <command> <options>
+commands: startup <problems> = Time to load the sent problems at startup. Default {0} problems.
+commands: throughput <notifications> <rate> <impacts> <latency> = Sends notifications to the webhook at rate
+          per second against a local fake tenant answering after latency ms. Reports the ack and end-to-end
+          latencies (p50/p99) and the notifications per second. Default {1} {2} {3} {4}.
+commands: poll <problems> <impacts> <latency> = Polls the problem feed of the fake tenant and calls the
+          integrations for all the problems. Default {1} {3} {4}.
+commands: coldstart <runs> = Time of new processes running webhook.py help, poll and archive, and the heavy
+          modules (Flask, Twilio...) loaded by importing the webhook. Default {5} runs.
+commands: incident <records> <parallelism> = Calls the sample legacy script for the records, starting a process
+          per record (spawn) and with long-lived workers (coprocess). Default {6} {7}.
+commands: tenants <notifications> <quiet> <latency> = Storm of notifications of a noisy tenant while a quiet tenant
+          of the same webhook sends quiet notifications. Reports the end-to-end latency of the quiet tenant
+          alone and during the storm. Default {1} {8} {4}.
+The webhook is loaded with the config.json of the repository, pointing to the fake tenant.
+=======================================================
+""".format(DEFAULT_PROBLEMS, DEFAULT_NOTIFICATIONS, DEFAULT_RATE, DEFAULT_IMPACTS, DEFAULT_LATENCY,
+           DEFAULT_RUNS, DEFAULT_RECORDS, DEFAULT_PARALLELISM, DEFAULT_QUIET)
+
+
+def get_int_argument(index, default):
+    return int(sys.argv[index]) if len(sys.argv) > index else default
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) >= 2 else ''
+    if command == 'startup':
+        benchmark_startup(get_int_argument(2, DEFAULT_PROBLEMS))
+    elif command == 'throughput':
+        benchmark_throughput(get_int_argument(2, DEFAULT_NOTIFICATIONS), get_int_argument(3, DEFAULT_RATE),
+                             get_int_argument(4, DEFAULT_IMPACTS), get_int_argument(5, DEFAULT_LATENCY))
+    elif command == 'poll':
+        benchmark_poll(get_int_argument(2, DEFAULT_NOTIFICATIONS), get_int_argument(3, DEFAULT_IMPACTS),
+                       get_int_argument(4, DEFAULT_LATENCY))
+    elif command == 'coldstart':
+        benchmark_coldstart(get_int_argument(2, DEFAULT_RUNS))
+    elif command == 'incident':
+        benchmark_incident(get_int_argument(2, DEFAULT_RECORDS), get_int_argument(3, DEFAULT_PARALLELISM))
+    elif command == 'tenants':
+        benchmark_tenants(get_int_argument(2, DEFAULT_NOTIFICATIONS), get_int_argument(3, DEFAULT_QUIET),
+                          get_int_argument(4, DEFAULT_LATENCY))
+    else:
+        print(get_usage_as_string())
+
+
+# Start Main
+if __name__ == "__main__": main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+#######################
+# Index of the notifications received within a time window by (PID, State).
+# A notification already in the window is a duplicate (e.g. a retry of
+# Dynatrace) and does not need to be processed again.
+#######################
+
+
+class DedupeIndex(object):
+
+    def __init__(self, window, max_entries):
+        # Seconds a notification is remembered
+        self.window = window
+        self.max_entries = max_entries
+        # Time (seconds) each (PID, State) was received, oldest first
+        self._received = OrderedDict()
+        self._lock = threading.Lock()
+        self.suppressed = 0
+
+    # Adds the notification. Returns False if it is a duplicate within the window.
+    def add(self, pid, state, received=None):
+        if received is None:
+            received = time.time()
+        key = (pid, state)
+        with self._lock:
+            self._expire(received)
+            if key in self._received:
+                self.suppressed += 1
+                return False
+            self._received[key] = received
+            while len(self._received) > self.max_entries:
+                self._received.popitem(last=False)
+            return True
+
+    # Forgets the notification, e.g. when it could not be processed and will be sent again
+    def discard(self, pid, state):
+        with self._lock:
+            self._received.pop((pid, state), None)
+
+    # Fills the index with notifications received before, oldest first (e.g. from the database)
+    def load(self, notifications):
+        with self._lock:
+            for pid, state, received in notifications:
+                self._received.pop((pid, state), None)
+                self._received[(pid, state)] = received
+            self._expire(time.time())
+
+    def _expire(self, now):
+        oldest_allowed = now - self.window
+        while self._received:
+            key, received = next(iter(self._received.items()))
+            if received >= oldest_allowed:
+                break
+            del self._received[key]
+
+    def __len__(self):
+        return len(self._received)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'window': self.window,
+                'size': len(self._received),
+                'suppressed': self.suppressed,
+            }
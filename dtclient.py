@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import codecs
+import json
+import logging
+import re
+import threading
+import timeit
+
+#######################
+# Shared client for the Dynatrace API.
+# All the calls go through one requests Session so the TCP+TLS connections
+# to the tenant are pooled and kept alive between calls. The session
+# can be used by several threads at the same time. The latency of each
+# call is recorded per endpoint. requests is imported with the first call,
+# so the commands not calling the API start without it. With a rate governor
+# every request (also every retry) waits for its turn in the lane of the call.
+#######################
+
+
+class DynatraceClient(object):
+
+    # The calls are made through the resilience target (retries and circuit breaker) if given
+    def __init__(self, tenant_host, api_token, pool_size, connect_timeout, read_timeout, verify=True, target=None,
+                 governor=None, pool_timeout=None):
+        self.tenant_host = tenant_host
+        self.target = target
+        self.governor = governor
+        self.timeout = (connect_timeout, read_timeout)
+        self.api_token = api_token
+        self.pool_size = pool_size
+        # Seconds a call waits for a free connection of the pool (None = no limit)
+        self.pool_timeout = pool_timeout
+        self.verify = verify
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._latencies = {}
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session()
+        return self._session
+
+    def _create_session(self):
+        import requests
+        session = requests.Session()
+        adapter = create_adapter(self.pool_size, self.pool_timeout)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.verify = self.verify
+        session.headers.update({
+            'Authorization': 'Api-Token ' + self.api_token,
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        return session
+
+    # Performs a GET on the endpoint. The path is appended to the endpoint,
+    # the endpoint alone is used for the latency statistics. A streamed
+    # response has to be closed by the caller.
+    def get(self, endpoint, path='', params=None, stream=False, lane=None):
+        return self.request('GET', endpoint, path, lane, params=params, stream=stream)
+
+    def post(self, endpoint, path='', json=None, lane=None):
+        return self.request('POST', endpoint, path, lane, json=json)
+
+    def request(self, method, endpoint, path='', lane=None, **kwargs):
+        url = self.tenant_host + endpoint + path
+        started_at = timeit.default_timer()
+        failed = True
+        try:
+            if self.target is None:
+                response = self._send(lane, method, url, timeout=self.timeout, **kwargs)
+            else:
+                # A POST is not repeated: it may have been done although it failed (e.g. a comment
+                # stored before a 5xx answer), the caller decides whether to retry it
+                response = self.target.call(self._send, lane, method, url, timeout=self.timeout,
+                                            is_failure=is_retryable_response,
+                                            attempts=self.target.attempts if method == 'GET' else 1, **kwargs)
+            failed = response.status_code >= 400
+            return response
+        finally:
+            self._record(method + ' ' + endpoint, timeit.default_timer() - started_at, failed)
+
+    def _send(self, lane, method, url, **kwargs):
+        if self.governor is not None:
+            self.governor.acquire(lane)
+        response = self.session.request(method, url, **kwargs)
+        if response.status_code == 429 and self.governor is not None:
+            seconds = self.governor.throttle(response.headers.get('Retry-After'))
+            logging.warning("Dynatrace API rate limit reached, requests paused for %.1fs", seconds)
+        return response
+
+    def _record(self, name, latency, failed):
+        with self._lock:
+            stats = self._latencies.get(name)
+            if stats is None:
+                stats = self._latencies[name] = {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0}
+            stats['count'] += 1
+            if failed:
+                stats['errors'] += 1
+            stats['total'] += latency
+            stats['max'] = max(stats['max'], latency)
+
+    # Latency statistics per endpoint in seconds
+    def stats(self):
+        with self._lock:
+            result = {}
+            for name, stats in self._latencies.items():
+                result[name] = {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'avg': stats['total'] / stats['count'],
+                    'max': stats['max'],
+                }
+            return result
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+
+# Adapter of requests keeping pool_size connections to the tenant. pool_block makes the threads
+# wait for a free connection instead of opening connections that are thrown away after the call,
+# for pool_timeout seconds at most (requests waits forever): if connections leak, the calls fail
+# with EmptyPoolError instead of blocking all the threads.
+def create_adapter(pool_size, pool_timeout):
+    from requests.adapters import HTTPAdapter
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def with_pool_timeout(pool_class):
+        class TimeoutPool(pool_class):
+            def _get_conn(self, timeout=None):
+                return pool_class._get_conn(self, pool_timeout if timeout is None else timeout)
+        return TimeoutPool
+
+    class TimeoutAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http': with_pool_timeout(HTTPConnectionPool),
+                                                       'https': with_pool_timeout(HTTPSConnectionPool)}
+
+    return TimeoutAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+
+
+# Server errors and rate limiting are worth a retry, the other errors are not
+def is_retryable_response(response):
+    return response.status_code >= 500 or response.status_code == 429
+
+
+# Start of the array of problems in the answer of the problem feed
+PROBLEMS_ARRAY = re.compile(r'"problems"\s*:\s*\[')
+
+
+# Yields the problems of a streamed problem feed response one by one, so the
+# whole answer is never held in memory. Only the decoded text of the current
+# problem is buffered.
+def iter_feed_problems(response, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = response.iter_content(chunk_size)
+    buffer = ''
+    pos = None
+    finished = False
+
+    while True:
+        if pos is None:
+            match = PROBLEMS_ARRAY.search(buffer)
+            if match:
+                pos = match.end()
+        else:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buffer):
+                if buffer[pos] == ']':
+                    return
+                try:
+                    problem, pos = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    # The problem is not complete yet
+                    if finished:
+                        raise
+                else:
+                    yield problem
+                    buffer = buffer[pos:]
+                    pos = 0
+                    continue
+        if finished:
+            if pos is None:
+                # There are no problems in the answer
+                return
+            raise ValueError('Incomplete problem feed')
+        chunk = next(chunks, None)
+        if chunk is None:
+            buffer += text_decoder.decode(b'', True)
+            finished = True
+        else:
+            buffer += text_decoder.decode(chunk)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import email.utils
+import threading
+import time
+import timeit
+
+#######################
+# Rate governor of the calls to the Dynatrace API.
+# Dynatrace limits the requests per API token, so all the callers take a
+# token of one shared bucket before every request. The bucket is refilled
+# at the configured rate and allows short bursts. The callers wait in
+# lanes: a token goes to the waiting lane with the highest priority, e.g.
+# the problem details are fetched before the comments are posted and the
+# comments before the feed is polled. When Dynatrace answers 429 the
+# bucket is emptied and paused for the time of the Retry-After header.
+# With several processes (worker processes, poll daemon) the bucket is
+# shared through the database: each process takes the tokens in small
+# batches from it, so the processes spend rate_limit together.
+#######################
+
+
+class RateGovernor(object):
+
+    # rate_limit: requests per minute (0 disables the governor), burst: requests
+    # made at once after an idle period, lanes: names from the highest priority
+    # (calls without a known lane wait in the last one). The time waited in each
+    # lane is observed in the histogram of the lane, if given. The tokens are taken
+    # from the shared bucket (SharedBucket) if given, instead of the local refill.
+    def __init__(self, rate_limit, burst, lanes, default_retry_after, histograms=None, shared=None):
+        self.rate = rate_limit / 60.0
+        self.burst = max(1, burst)
+        self.shared = shared
+        # Tokens taken at once from the shared bucket: about one second of requests
+        self.batch = max(1, min(self.burst, int(self.rate)))
+        self.lanes = dict((lane, priority) for priority, lane in enumerate(lanes))
+        self.default_lane = lanes[-1]
+        self.default_retry_after = default_retry_after
+        self.histograms = histograms or {}
+        # With a shared bucket all the tokens come from it
+        self._tokens = float(self.burst) if shared is None else 0.0
+        self._updated = timeit.default_timer()
+        self._paused_until = 0.0
+        self._next_take = 0.0
+        self._waiting = [0] * len(lanes)
+        self._condition = threading.Condition()
+        self._stats = dict((lane, {'acquired': 0, 'waited': 0, 'wait_total': 0.0, 'wait_max': 0.0})
+                           for lane in lanes)
+        self.throttled = 0
+
+    # Blocks until the caller of the lane may make a request
+    def acquire(self, lane):
+        if not self.rate:
+            return
+        if lane not in self.lanes:
+            lane = self.default_lane
+        priority = self.lanes[lane]
+        started_at = timeit.default_timer()
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = timeit.default_timer()
+                    wait = self._get_wait(priority, now)
+                    if wait <= 0:
+                        self._tokens -= 1
+                        break
+                    self._condition.wait(wait)
+            finally:
+                self._waiting[priority] -= 1
+            # The lanes behind may take the next token
+            self._condition.notify_all()
+            waited = timeit.default_timer() - started_at
+            stats = self._stats[lane]
+            stats['acquired'] += 1
+            if waited > 0.001:
+                stats['waited'] += 1
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+        histogram = self.histograms.get(lane)
+        if histogram is not None:
+            histogram.observe(waited)
+
+    # Seconds to wait before the lane can take a token, 0 if it can take it now
+    def _get_wait(self, priority, now):
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.shared is None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+        elif self._tokens < 1:
+            # The shared bucket is asked again when it has the next token
+            if now < self._next_take:
+                return self._next_take - now
+            taken, wait = self.shared.take(self.batch)
+            self._tokens += taken
+            if self._tokens < 1:
+                self._next_take = now + wait
+                return wait
+        if any(self._waiting[:priority]):
+            # A lane with a higher priority takes the token and notifies the others
+            return 1.0 / self.rate
+        return 0
+
+    # Called with the Retry-After header of a 429 answer: no request is made until then
+    def throttle(self, retry_after=None):
+        seconds = parse_retry_after(retry_after)
+        if seconds is None:
+            seconds = self.default_retry_after
+        with self._condition:
+            self.throttled += 1
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, timeit.default_timer() + seconds)
+            self._updated = self._paused_until
+        if self.shared is not None:
+            self.shared.pause(seconds)
+        return seconds
+
+    def stats(self):
+        with self._condition:
+            lanes = {}
+            for lane, stats in self._stats.items():
+                lanes[lane] = {
+                    'acquired': stats['acquired'],
+                    'waited': stats['waited'],
+                    'waiting': self._waiting[self.lanes[lane]],
+                    'avg_wait': stats['wait_total'] / stats['acquired'] if stats['acquired'] else 0.0,
+                    'max_wait': stats['wait_max'],
+                }
+            paused = max(0.0, self._paused_until - timeit.default_timer())
+            return {'lanes': lanes, 'throttled': self.throttled, 'paused': paused}
+
+
+# Token bucket of the API token kept in the database (ProblemStore) of the tenant, shared by
+# the governors of all the processes
+class SharedBucket(object):
+
+    def __init__(self, store, name, rate_limit, burst):
+        self.store = store
+        self.name = name
+        self.rate = rate_limit / 60.0
+        self.burst = max(1, burst)
+
+    # Takes up to wanted tokens, returns the tokens taken and the seconds until the next one
+    def take(self, wanted):
+        return self.store.take_rate_tokens(self.name, wanted, self.rate, self.burst)
+
+    # No token is given to any process for the seconds
+    def pause(self, seconds):
+        self.store.pause_rate_tokens(self.name, time.time() + seconds)
+
+
+# Seconds of a Retry-After header, given in seconds or as an HTTP date. None if missing or invalid.
+def parse_retry_after(value):
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
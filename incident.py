@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import re
+import shlex
+import subprocess
+import threading
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+#######################
+# Calls the Incident Software executable for a list of arguments.
+# The calls are spawned without a shell (argv based) by a shared pool, so
+# the amount of processes running at the same time is bounded by the
+# parallelism. Several arguments can be batched in one call for
+# executables that accept multiple records.
+# In co-process mode the records are sent instead to long-lived worker
+# processes of the Incident Software over a line protocol on stdin/stdout,
+# so no process is started per call:
+#   webhook -> worker: CALL<tab><record>   worker -> webhook: <return code>
+#   webhook -> worker: PING                worker -> webhook: PONG
+# The workers are started with the first call, pinged by the health check
+# and restarted when they crashed, hung or answered out of protocol.
+#######################
+
+# Return codes reported when the executable could not be called, following
+# the conventions of the shells (timeout(1) and command not found).
+RC_TIMEOUT = 124
+RC_NOT_FOUND = 127
+# Return code reported when a co-process worker died or broke the protocol during a call
+RC_WORKER_LOST = 125
+
+PROTOCOL_CALL = 'CALL'
+PROTOCOL_PING = 'PING'
+PROTOCOL_PONG = 'PONG'
+
+# Characters separating the lines and fields of the protocol, replaced by spaces in the records
+PROTOCOL_SEPARATORS = re.compile(r'[\t\r\n]')
+
+
+# Splits the configured executable (e.g. '/bin/sh legacy_script.sh') in argv
+def split_command(executable):
+    return shlex.split(executable, posix=(os.name != 'nt'))
+
+
+class IncidentExecutor(object):
+
+    # The calls are made through the resilience target (retries and circuit breaker) if given.
+    # Only the calls that timed out or lost their worker are retried, the executable can fail
+    # after doing its work. The duration of every call is observed in the histogram if given.
+    # With a pool of co-process workers the records are sent to the workers instead.
+    def __init__(self, executable, parallelism, timeout, batch_size=1, target=None, histogram=None, pool=None):
+        self.command = split_command(executable)
+        self.target = target
+        self.histogram = histogram
+        self.pool = pool
+        self.timeout = timeout
+        self.batch_size = max(1, batch_size)
+        self._pool = ThreadPoolExecutor(max_workers=parallelism)
+
+    # Splits the arguments in the records of each call
+    def get_batches(self, argument_list):
+        return [argument_list[i:i + self.batch_size] for i in range(0, len(argument_list), self.batch_size)]
+
+    # Calls the executable once per batch of arguments. Returns the list of
+    # (batch, return code) in the same order as the arguments.
+    def call_all(self, argument_list):
+        batches = self.get_batches(argument_list)
+        futures = [self._pool.submit(self.call, batch) for batch in batches]
+        return [(batch, future.result()) for batch, future in zip(batches, futures)]
+
+    def call(self, arguments):
+        run = self.spawn if self.pool is None else self.send
+        if self.target is None:
+            return run(arguments)
+        return self.target.call(run, arguments, is_failure=is_retryable_return_code)
+
+    def send(self, arguments):
+        started_at = timeit.default_timer()
+        try:
+            return self.pool.call(arguments)
+        finally:
+            if self.histogram is not None:
+                self.histogram.observe(timeit.default_timer() - started_at)
+
+    def spawn(self, arguments):
+        argv = self.command + list(arguments)
+        started_at = timeit.default_timer()
+        try:
+            return subprocess.call(argv, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            logging.error('Incident Software call timed out after %ss: %s', self.timeout, argv)
+            return RC_TIMEOUT
+        except OSError as e:
+            logging.error('Incident Software could not be called: %s %s', argv, e)
+            return RC_NOT_FOUND
+        finally:
+            if self.histogram is not None:
+                self.histogram.observe(timeit.default_timer() - started_at)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+        if self.pool is not None:
+            self.pool.close()
+
+
+def is_retryable_return_code(return_code):
+    return return_code in (RC_TIMEOUT, RC_WORKER_LOST)
+
+
+class WorkerLostError(Exception):
+    pass
+
+
+class WorkerTimeoutError(Exception):
+    pass
+
+
+# One long-lived process of the Incident Software. Its answers are read by a
+# background thread, so a hung worker can be given up after the timeout.
+class CoprocessWorker(object):
+
+    def __init__(self, command, name):
+        self.command = command
+        self.name = name
+        self.process = None
+        self._answers = None
+
+    def is_started(self):
+        return self.process is not None
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=1,
+                                        universal_newlines=True)
+        self._answers = queue.Queue()
+        reader = threading.Thread(target=read_answers, args=(self.process.stdout, self._answers),
+                                  name=self.name + '-reader')
+        reader.daemon = True
+        reader.start()
+
+    # Sends the lines at once and returns an answer per line
+    def request(self, lines, timeout):
+        try:
+            self.process.stdin.write(''.join(lines))
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise WorkerLostError('{0} could not be written: {1}'.format(self.name, e))
+        deadline = timeit.default_timer() + timeout
+        answers = []
+        for _ in lines:
+            try:
+                answer = self._answers.get(timeout=max(0, deadline - timeit.default_timer()))
+            except queue.Empty:
+                raise WorkerTimeoutError('{0} did not answer within {1}s'.format(self.name, timeout))
+            if answer is None:
+                raise WorkerLostError('{0} exited with return code {1}'.format(self.name, self.process.wait()))
+            answers.append(answer)
+        return answers
+
+    # Closing stdin ends the worker, it is killed if it does not end within the timeout
+    def stop(self, timeout=0):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+# Puts the lines written by the worker in the queue, None when the worker exited
+def read_answers(stdout, answers):
+    for line in iter(stdout.readline, ''):
+        answers.put(line.rstrip('\r\n'))
+    answers.put(None)
+
+
+def get_call_line(record):
+    return PROTOCOL_CALL + '\t' + PROTOCOL_SEPARATORS.sub(' ', str(record)) + '\n'
+
+
+# Fixed pool of co-process workers, each serving one call at a time
+class CoprocessPool(object):
+
+    def __init__(self, executable, size, timeout):
+        self.command = split_command(executable)
+        self.timeout = timeout
+        self.workers = [CoprocessWorker(self.command, 'incident-worker-{0}'.format(i)) for i in range(size)]
+        self._idle = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.restarts = 0
+        self.lost = 0
+        self.timeouts = 0
+        self.unhealthy = 0
+
+    # Sends the records to an idle worker. Returns 0 if the worker answered 0 for
+    # every record, else the first other return code.
+    def call(self, records):
+        worker = self._idle.get()
+        try:
+            return self._call(worker, records)
+        finally:
+            self._idle.put(worker)
+
+    def _call(self, worker, records):
+        with self._lock:
+            self.calls += 1
+        try:
+            self._ensure_started(worker)
+        except OSError as e:
+            logging.error('Incident Software worker could not be started: %s %s', self.command, e)
+            return RC_NOT_FOUND
+        try:
+            answers = worker.request([get_call_line(record) for record in records], self.timeout)
+            return_codes = [int(answer) for answer in answers]
+        except WorkerTimeoutError as e:
+            logging.error('Incident Software call timed out: %s', e)
+            self._discard(worker, 'timeouts')
+            return RC_TIMEOUT
+        except WorkerLostError as e:
+            logging.error('Incident Software worker lost during a call: %s', e)
+            self._discard(worker, 'lost')
+            return RC_WORKER_LOST
+        except ValueError as e:
+            logging.error('Incident Software worker %s answered out of protocol: %s', worker.name, e)
+            self._discard(worker, 'lost')
+            return RC_WORKER_LOST
+        for return_code in return_codes:
+            if return_code:
+                return return_code
+        return 0
+
+    # A worker that exited is started again
+    def _ensure_started(self, worker):
+        if worker.is_alive():
+            return
+        if worker.is_started():
+            logging.warning('Incident Software worker %s exited, restarting it', worker.name)
+            worker.stop()
+            with self._lock:
+                self.restarts += 1
+        worker.start()
+
+    # The worker is killed, it is restarted by the next call
+    def _discard(self, worker, counter):
+        worker.stop()
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    # Pings the idle workers already started, the ones not answering are restarted.
+    # Called periodically.
+    def check_health(self):
+        workers = []
+        try:
+            while len(workers) < len(self.workers):
+                workers.append(self._idle.get_nowait())
+        except queue.Empty:
+            pass
+        try:
+            for worker in workers:
+                if not worker.is_started():
+                    continue
+                try:
+                    if not worker.is_alive():
+                        raise WorkerLostError('{0} exited'.format(worker.name))
+                    if worker.request([PROTOCOL_PING + '\n'], self.timeout) != [PROTOCOL_PONG]:
+                        raise WorkerLostError('{0} did not answer the health check'.format(worker.name))
+                except (WorkerLostError, WorkerTimeoutError) as e:
+                    logging.warning('Incident Software worker unhealthy, restarting it: %s', e)
+                    self._discard(worker, 'unhealthy')
+                    try:
+                        self._ensure_started(worker)
+                    except OSError as e:
+                        logging.error('Incident Software worker could not be started: %s %s', self.command, e)
+        finally:
+            for worker in workers:
+                self._idle.put(worker)
+
+    def close(self, timeout=5):
+        for worker in self.workers:
+            worker.stop(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': len(self.workers), 'alive': sum(1 for worker in self.workers if worker.is_alive()),
+                    'calls': self.calls, 'restarts': self.restarts, 'lost': self.lost, 'timeouts': self.timeouts,
+                    'unhealthy': self.unhealthy}
@@ -0,0 +1,21 @@
+#!/bin/sh
+#Sample co-process worker of the legacy program (mode coprocess).
+#It reads one request per line on stdin and answers one line on stdout:
+#  CALL<tab><record>  ->  the return code of the record (0 = OK)
+#  PING               ->  PONG
+#Anything else written by the program must go to stderr.
+while IFS= read -r line; do
+    case "$line" in
+        PING)
+            echo PONG
+            ;;
+        CALL*)
+            record=${line#CALL}
+            echo "program called with a record to $0: ${record#?}" >&2
+            echo 0
+            ;;
+        *)
+            echo 2
+            ;;
+    esac
+done
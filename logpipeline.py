@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import logging
+import re
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+#######################
+# Asynchronous logging of the webhook.
+# The threads handling the requests only put the log records in a bounded
+# queue; a background listener formats them and writes them to the file
+# and the console. The message of a record is built from its arguments in
+# the listener, so a disabled level costs nothing and an enabled one costs
+# no formatting in the request path. Secrets are redacted before writing.
+#######################
+
+# Attributes of every LogRecord, the other attributes come from extra={...}
+STANDARD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None)).keys()) | {'message', 'asctime'}
+
+REDACTED = '***'
+
+# Formats the tracebacks before they are redacted
+EXCEPTION_FORMATTER = logging.Formatter()
+
+# Credentials in headers or URLs that must never be written
+SECRET_PATTERNS = [
+    re.compile(r'(Api-Token\s+)[^\s\'",]+', re.IGNORECASE),
+    re.compile(r'(Api-Token=)[^\s&\'",]+', re.IGNORECASE),
+]
+
+
+# Puts the records in the queue without formatting them. When the queue is
+# full the record is dropped instead of blocking the caller.
+class AsyncQueueHandler(QueueHandler):
+
+    def __init__(self, log_queue):
+        QueueHandler.__init__(self, log_queue)
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+# Replaces the secrets (and the credentials matching SECRET_PATTERNS) in the message, the
+# exception text and the fields given with extra={...} of the record
+class RedactingFilter(logging.Filter):
+
+    def __init__(self, secrets):
+        logging.Filter.__init__(self)
+        # Longest first, so a secret containing another one is replaced as a whole
+        self.secrets = sorted([secret for secret in secrets if secret], key=len, reverse=True)
+
+    def filter(self, record):
+        message = record.getMessage()
+        redacted = self.redact(message)
+        if redacted != message:
+            record.msg = redacted
+            record.args = None
+        # The traceback is formatted here, the formatters then write the redacted text
+        if record.exc_info and not record.exc_text:
+            record.exc_text = EXCEPTION_FORMATTER.formatException(record.exc_info)
+        if record.exc_text:
+            record.exc_text = self.redact(record.exc_text)
+        if record.stack_info:
+            record.stack_info = self.redact(record.stack_info)
+        for key, value in list(record.__dict__.items()):
+            if key not in STANDARD_ATTRIBUTES and not key.startswith('_'):
+                text = value if isinstance(value, str) else str(value)
+                redacted = self.redact(text)
+                if redacted != text:
+                    setattr(record, key, redacted)
+        return True
+
+    def redact(self, text):
+        for secret in self.secrets:
+            text = text.replace(secret, REDACTED)
+        for pattern in SECRET_PATTERNS:
+            text = pattern.sub(r'\1' + REDACTED, text)
+        return text
+
+
+# One JSON object per line with the time, level, logger, thread and message of the
+# record, plus the fields given with extra={...} (e.g. problem, pid, duration).
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        elif record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class LogPipeline(object):
+
+    # The handlers (e.g. file and console) are written by the background listener
+    def __init__(self, handlers, queue_size, secrets=()):
+        self.handlers = handlers
+        redacting_filter = RedactingFilter(secrets)
+        for handler in handlers:
+            handler.addFilter(redacting_filter)
+        self.queue_handler = AsyncQueueHandler(queue.Queue(maxsize=queue_size))
+        self.listener = QueueListener(self.queue_handler.queue, *handlers, respect_handler_level=True)
+        self._started = False
+
+    # Sends the records of the root logger through the queue
+    def start(self, level):
+        root = logging.getLogger()
+        root.setLevel(level)
+        root.addHandler(self.queue_handler)
+        self.listener.start()
+        self._started = True
+
+    # Writes the records still in the queue and stops the listener
+    def stop(self):
+        if self._started:
+            self._started = False
+            self.listener.stop()
+
+    def stats(self):
+        return {'queued': self.queue_handler.queue.qsize(), 'dropped': self.queue_handler.dropped}
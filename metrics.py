@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import bisect
+import threading
+import timeit
+
+#######################
+# Metrics of the webhook in the Prometheus text format.
+# Counters and latency histograms are updated in the hot path: an update
+# is a bisect over the fixed buckets and a few additions under a lock, no
+# allocation. Gauges (queue depths, cache sizes...) are read from the
+# components only when the metrics are scraped.
+#######################
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds (seconds) of the latency buckets, from a local call to a slow external one
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Counter(object):
+
+    def __init__(self, name, labels=None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class Histogram(object):
+
+    def __init__(self, name, labels=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    # Context manager observing the seconds spent in the block
+    def time(self):
+        return Timer(self)
+
+    def stats(self):
+        with self._lock:
+            return {'count': self._count, 'sum': self._sum, 'avg': self._sum / self._count if self._count else 0.0}
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+            count = self._count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            labels = dict(self.labels)
+            labels['le'] = format_value(bound)
+            samples.append((self.name + '_bucket', labels, cumulative))
+        samples.append((self.name + '_sum', self.labels, total))
+        samples.append((self.name + '_count', self.labels, count))
+        return samples
+
+
+class Timer(object):
+
+    __slots__ = ('histogram', 'started_at')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started_at = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.histogram.observe(timeit.default_timer() - self.started_at)
+        return False
+
+
+# Value read from a function when the metrics are scraped
+class FunctionMetric(object):
+
+    def __init__(self, name, function, labels=None):
+        self.name = name
+        self.function = function
+        self.labels = labels or {}
+
+    def samples(self):
+        return [(self.name, self.labels, self.function())]
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        # name -> (type, help text, [metrics with the name and different labels])
+        self._families = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text, labels=None):
+        return self._register(name, 'counter', help_text, Counter(name, labels))
+
+    def histogram(self, name, help_text, labels=None, buckets=DEFAULT_BUCKETS):
+        return self._register(name, 'histogram', help_text, Histogram(name, labels, buckets))
+
+    # Gauge read from function() when scraped
+    def gauge(self, name, help_text, function, labels=None):
+        return self._register(name, 'gauge', help_text, FunctionMetric(name, function, labels))
+
+    # Counter kept by a component (e.g. the hits of a cache), read from function() when scraped
+    def counter_function(self, name, help_text, function, labels=None):
+        return self._register(name, 'counter', help_text, FunctionMetric(name, function, labels))
+
+    def _register(self, name, metric_type, help_text, metric):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = (metric_type, help_text, [])
+                self._order.append(name)
+            elif family[0] != metric_type:
+                raise ValueError('Metric {0} already registered as {1}'.format(name, family[0]))
+            family[2].append(metric)
+        return metric
+
+    # All the metrics in the Prometheus text exposition format
+    def render(self):
+        with self._lock:
+            families = [(name,) + self._families[name] for name in self._order]
+        lines = []
+        for name, metric_type, help_text, metrics in families:
+            lines.append('# HELP {0} {1}'.format(name, help_text.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            for metric in metrics:
+                for sample_name, labels, value in metric.samples():
+                    lines.append('{0}{1} {2}'.format(sample_name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, escape_label_value(value))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
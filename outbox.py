@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import timeit
+
+#######################
+# Outbox for the comments posted in the Dynatrace problems.
+# Comments for the same problem added within the window are merged and
+# posted with one call. A few background threads post the comments of
+# different problems at the same time (the comments of one problem are
+# posted one after the other). Failed posts are retried with an
+# increasing delay. When max_pending comments are waiting, the new ones
+# are given to the failed function (e.g. parked in the retry queue).
+#######################
+
+
+class CommentOutbox(object):
+
+    def __init__(self, post_function, window, max_attempts, retry_delay, failed_function=None, posters=1,
+                 max_pending=None):
+        # post_function(problem, data) posts the comment and returns the response
+        self.post_function = post_function
+        # failed_function(problem, data, reason) is called when the comment could not be posted
+        self.failed_function = failed_function
+        self.window = window
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Threads posting at the same time and comments waiting at most (None = no limit)
+        self.posters = max(1, posters)
+        self.max_pending = max_pending
+        # Comments waiting to be posted by problem id, problems being posted and comments waiting
+        self._pending = {}
+        self._in_flight = set()
+        self._pending_comments = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        self._started = 0
+        self._posting = 0
+        self.added = 0
+        self.sent = 0
+        self.posts = 0
+        self.retries = 0
+        self.failed = 0
+        self.overflowed = 0
+
+    # Queues a comment (dict with comment, user and context) for the problem.
+    # Returns False if the outbox is full (the comment is given to the failed function).
+    def add(self, problem, data):
+        with self._condition:
+            full = self.max_pending is not None and self._pending_comments >= self.max_pending
+            if full:
+                self.overflowed += 1
+            else:
+                entry = self._pending.get(problem['id'])
+                if entry is None:
+                    entry = self._pending[problem['id']] = {
+                        'problem': problem, 'comments': [], 'due': timeit.default_timer() + self.window,
+                        'attempts': 0}
+                entry['comments'].append(data)
+                self._pending_comments += 1
+                self.added += 1
+                self._start()
+                self._condition.notify()
+        if full:
+            logging.warning('Comment outbox full (%s comments waiting), the comment for problem %s is not queued',
+                            self.max_pending, problem['displayName'])
+            self._fail(problem, data, 'Comment outbox full')
+            return False
+        return True
+
+    # Threads that died are replaced
+    def _start(self):
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.posters:
+            self._started += 1
+            thread = threading.Thread(target=self._work, name='comment-outbox-{0}'.format(self._started))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                entry = self._take_due()
+                while entry is None:
+                    self._condition.wait(self._time_to_next_due())
+                    entry = self._take_due()
+                self._posting += 1
+            try:
+                self._post(entry)
+            except Exception:
+                # The thread goes on with the next comments
+                logging.error('Error posting the comments of problem %s', entry['problem']['displayName'],
+                              exc_info=True)
+            finally:
+                with self._condition:
+                    self._posting -= 1
+                    self._in_flight.discard(entry['problem']['id'])
+                    self._condition.notify_all()
+
+    # The entry due first of the problems not being posted, None if there is none
+    def _take_due(self):
+        now = timeit.default_timer()
+        due = [(entry['due'], pid) for pid, entry in self._pending.items()
+               if entry['due'] <= now and pid not in self._in_flight]
+        if not due:
+            return None
+        pid = min(due)[1]
+        entry = self._pending.pop(pid)
+        self._pending_comments -= len(entry['comments'])
+        self._in_flight.add(pid)
+        return entry
+
+    def _time_to_next_due(self):
+        dues = [entry['due'] for pid, entry in self._pending.items() if pid not in self._in_flight]
+        if not dues:
+            return None
+        return max(0, min(dues) - timeit.default_timer())
+
+    # All the comments of the entry are posted as one comment
+    def _post(self, entry):
+        problem = entry['problem']
+        comments = entry['comments']
+        data = merge_comments(comments)
+        try:
+            r = self.post_function(problem, data)
+            if r.status_code < 300:
+                with self._condition:
+                    self.posts += 1
+                    self.sent += len(comments)
+                logging.info('Problem %s was commented successfully in Dynatrace (%s comments)',
+                             problem['displayName'], len(comments))
+                logging.debug('Content:%s', data)
+                return
+            reason = '{0}-{1}'.format(r.reason, r.status_code)
+        except Exception as e:
+            reason = str(e)
+            logging.debug("Traceback of the error", exc_info=True)
+        self._retry(entry, reason, data)
+
+    def _retry(self, entry, reason, data):
+        problem = entry['problem']
+        entry['attempts'] += 1
+        if entry['attempts'] >= self.max_attempts:
+            with self._condition:
+                self.failed += len(entry['comments'])
+            logging.error('Problem %s could not be commented in Dynatrace after %s attempts. Reason %s. Content:%s',
+                          problem['displayName'], entry['attempts'], reason, data)
+            self._fail(problem, data, reason)
+            return
+        logging.warning('Problem %s could not be commented in Dynatrace. Reason %s. Retrying',
+                        problem['displayName'], reason)
+        with self._condition:
+            self.retries += 1
+            entry['due'] = timeit.default_timer() + self.retry_delay * 2 ** (entry['attempts'] - 1)
+            # Comments added meanwhile for the same problem are posted with the retry
+            newer = self._pending.pop(problem['id'], None)
+            if newer is not None:
+                entry['comments'].extend(newer['comments'])
+                self._pending_comments -= len(newer['comments'])
+            self._pending[problem['id']] = entry
+            self._pending_comments += len(entry['comments'])
+            self._condition.notify()
+
+    # Gives the comment to the failed function. Its errors (e.g. the database is locked) are
+    # logged, so they neither stop the posting threads nor the caller adding the comment.
+    def _fail(self, problem, data, reason):
+        if self.failed_function is None:
+            return
+        try:
+            self.failed_function(problem, data, reason)
+        except Exception:
+            logging.error('The comment for problem %s is lost. Content:%s', problem['displayName'], data,
+                          exc_info=True)
+
+    # Posts the pending comments now and waits (up to timeout seconds) until they are sent
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else timeit.default_timer() + timeout
+        with self._condition:
+            for entry in self._pending.values():
+                entry['due'] = min(entry['due'], timeit.default_timer())
+            self._condition.notify_all()
+            while self._pending or self._posting:
+                remaining = None if deadline is None else deadline - timeit.default_timer()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    # Flush at exit: the comments still waiting after timeout seconds (e.g. for a retry) are
+    # given to the failed function instead of being lost with the process. Returns True if all
+    # the comments were posted.
+    def close(self, timeout):
+        if self.flush(timeout):
+            return True
+        with self._condition:
+            entries = list(self._pending.values())
+            self._pending.clear()
+            for entry in entries:
+                self._pending_comments -= len(entry['comments'])
+        for entry in entries:
+            self._fail(entry['problem'], merge_comments(entry['comments']), 'Not posted before exit')
+        return False
+
+    def pending(self):
+        with self._condition:
+            return self._pending_comments
+
+    def stats(self):
+        with self._condition:
+            return {
+                'pending': self._pending_comments,
+                'posting': self._posting,
+                'added': self.added,
+                'sent': self.sent,
+                'posts': self.posts,
+                'retries': self.retries,
+                'failed': self.failed,
+                'overflowed': self.overflowed,
+            }
+
+
+# Merges the comments of a problem in one comment. The contexts of the integrations are joined.
+def merge_comments(comments):
+    if len(comments) == 1:
+        return comments[0]
+    contexts = []
+    for data in comments:
+        if data['context'] not in contexts:
+            contexts.append(data['context'])
+    return {
+        'comment': '\n\n'.join([data['comment'] for data in comments]),
+        'user': comments[0]['user'],
+        'context': ' / '.join(contexts),
+    }
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import random
+import threading
+import time
+import timeit
+
+#######################
+# Resilience of the calls to the outbound targets (Dynatrace API, Twilio,
+# Incident Software). Failed calls are retried with exponential backoff
+# and jitter. A circuit breaker per target fails fast while the target is
+# down, and the work that could not be done is parked in a durable retry
+# queue instead of keeping the workers busy.
+#######################
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        # Consecutive failures opening the circuit
+        self.failure_threshold = failure_threshold
+        # Seconds the circuit stays open before a trial call is let through
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened = 0
+
+    # Raises CircuitOpenError if the call must not be made
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and timeit.default_timer() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.HALF_OPEN and not self._trial:
+                # Only one trial call while half-open
+                self._trial = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError("Circuit of '{0}' is open, call not made".format(self.name))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logging.info("Circuit of '%s' closed, the target is back", self.name)
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                 self._failures >= self.failure_threshold):
+                if self.state == self.CLOSED:
+                    logging.error("Circuit of '%s' opened after %s failures", self.name, self._failures)
+                self.state = self.OPEN
+                self._opened_at = timeit.default_timer()
+                self.opened += 1
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self._failures, 'opened': self.opened,
+                    'rejected': self.rejected}
+
+
+class Target(object):
+
+    def __init__(self, name, attempts, base_delay, max_delay, failure_threshold, reset_timeout):
+        self.name = name
+        self.attempts = attempts
+        # Seconds of the first backoff, doubled with each attempt up to max_delay
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.calls = 0
+        self.retries = 0
+        self.failed = 0
+
+    # Calls the function with retries. A result for which is_failure returns True
+    # is retried like an exception (and closed if it can be, e.g. a response holding
+    # a pooled connection); after the last attempt it is returned as is. attempts
+    # overrides the attempts of the target, e.g. 1 for the calls that must not be repeated.
+    def call(self, function, *args, **kwargs):
+        is_failure = kwargs.pop('is_failure', None)
+        attempts = kwargs.pop('attempts', self.attempts)
+        self.calls += 1
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                self.breaker.record_failure()
+                if attempt >= attempts:
+                    self.failed += 1
+                    raise
+                logging.warning("Call to '%s' failed (attempt %s of %s): %s", self.name, attempt, attempts, e)
+            else:
+                if is_failure is None or not is_failure(result):
+                    self.breaker.record_success()
+                    return result
+                self.breaker.record_failure()
+                if attempt >= attempts:
+                    self.failed += 1
+                    return result
+                logging.warning("Call to '%s' failed (attempt %s of %s)", self.name, attempt, attempts)
+                close = getattr(result, 'close', None)
+                if close is not None:
+                    close()
+            self.retries += 1
+            time.sleep(self.get_backoff(attempt))
+
+    # Exponential backoff with full jitter
+    def get_backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def stats(self):
+        stats = self.breaker.stats()
+        stats.update({'calls': self.calls, 'retries': self.retries, 'failed': self.failed})
+        return stats
+
+
+# Work parked in the database to be done later. Each kind of work has a handler
+# receiving the payload; when it raises, the work is tried again later.
+class RetryQueue(object):
+
+    def __init__(self, store, max_attempts, base_delay, max_delay):
+        self.store = store
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.handlers = {}
+        self._lock = threading.Lock()
+        self.parked = 0
+        self.done = 0
+        self.dropped = 0
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def park(self, kind, payload, reason=''):
+        logging.warning("Work '%s' parked in the retry queue: %s", kind, reason)
+        self.store.add_retry(kind, json.dumps(payload), time.time() + self.base_delay)
+        with self._lock:
+            self.parked += 1
+
+    # Does the work that is due. Called periodically. proceed() is called before each work,
+    # the drain stops when it returns False (e.g. the lease of the task was lost).
+    def drain(self, proceed=None):
+        for retry_id, kind, payload, attempts in self.store.load_due_retries(time.time()):
+            if proceed is not None and not proceed():
+                return
+            handler = self.handlers.get(kind)
+            try:
+                handler(json.loads(payload))
+            except Exception as e:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    logging.error("Work '%s' dropped from the retry queue after %s attempts: %s %s", kind, attempts,
+                                  payload, e)
+                    self.store.delete_retry(retry_id)
+                    with self._lock:
+                        self.dropped += 1
+                else:
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempts)
+                    self.store.reschedule_retry(retry_id, attempts, time.time() + random.uniform(delay / 2, delay))
+                if isinstance(e, CircuitOpenError):
+                    # The target is still down, the rest will not have more luck
+                    return
+            else:
+                self.store.delete_retry(retry_id)
+                with self._lock:
+                    self.done += 1
+
+    def stats(self):
+        with self._lock:
+            return {'pending': self.store.count_retries(), 'parked': self.parked, 'done': self.done,
+                    'dropped': self.dropped}
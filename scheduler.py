@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import logging
+import random
+import threading
+import timeit
+
+#######################
+# Runs a function periodically in a background thread.
+# A random jitter is added to each interval so several instances do not
+# hit the API at the same time. A run never overlaps with the previous
+# one: ticks that come while a run is still going are skipped.
+#######################
+
+
+class PeriodicTask(object):
+
+    def __init__(self, name, function, interval, jitter=0):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.jitter = jitter
+        self._running = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.failed = 0
+        self.skipped = 0
+        self.last_duration = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run_forever, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Runs the task until stopped, in the calling thread
+    def run_forever(self):
+        logging.info("Task '%s' scheduled every %ss (jitter %ss)", self.name, self.interval, self.jitter)
+        next_run = timeit.default_timer()
+        while not self._stopped.is_set():
+            self.run_once()
+            next_run += self.interval
+            now = timeit.default_timer()
+            if next_run < now:
+                # The run took longer than the interval, the missed ticks are skipped
+                missed = int((now - next_run) // self.interval) + 1
+                self.skipped += missed
+                next_run += missed * self.interval
+                logging.warning("Task '%s' took %.1fs, %s run(s) skipped", self.name, self.last_duration, missed)
+            self._stopped.wait(next_run - now + random.uniform(0, self.jitter))
+
+    # Runs the task now unless it is already running. Returns False if it was skipped.
+    def run_once(self):
+        if not self._running.acquire(False):
+            self.skipped += 1
+            logging.warning("Task '%s' is still running, run skipped", self.name)
+            return False
+        started_at = timeit.default_timer()
+        try:
+            self.function()
+        except Exception:
+            self.failed += 1
+            logging.error("There was an error running the task '%s'", self.name, exc_info=True)
+        finally:
+            self.runs += 1
+            self.last_duration = timeit.default_timer() - started_at
+            self._running.release()
+        return True
+
+    def is_started(self):
+        return self._thread is not None
+
+    def is_running(self):
+        return self._running.locked()
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'last_duration': self.last_duration,
+            'running': self.is_running(),
+        }
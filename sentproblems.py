@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+#######################
+# In-memory index of the problems sent to the integrations.
+# Each problem is kept as a compact record with the fields needed to detect
+# new problems and show them. CLOSED problems are evicted by age and count
+# so the memory is bounded; they are still in the database.
+#######################
+
+
+class ProblemRecord(object):
+    __slots__ = ('display_name', 'pid', 'status', 'start_time', 'end_time', 'updated')
+
+    def __init__(self, display_name, pid, status, start_time, end_time, updated):
+        self.display_name = display_name
+        self.pid = pid
+        self.status = status
+        self.start_time = start_time
+        self.end_time = end_time
+        # Time (milliseconds) the problem was sent
+        self.updated = updated
+
+    @classmethod
+    def from_details(cls, problem_details, updated=None):
+        if updated is None:
+            updated = int(time.time() * 1000)
+        return cls(problem_details['displayName'], problem_details['id'], problem_details['status'],
+                   problem_details.get('startTime'), problem_details.get('endTime'), updated)
+
+    def is_closed(self):
+        return self.status != 'OPEN'
+
+    # Approximate bytes used by the record and its values
+    def size(self):
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, name)) for name in self.__slots__)
+
+
+class SentProblems(object):
+
+    def __init__(self, max_closed, max_closed_age):
+        self.max_closed = max_closed
+        # Seconds a CLOSED problem is kept after being sent
+        self.max_closed_age = max_closed_age
+        self._records = {}
+        # Names of the CLOSED problems in the order they were sent
+        self._closed = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def get(self, display_name):
+        return self._records.get(display_name)
+
+    def __len__(self):
+        return len(self._records)
+
+    def put(self, record):
+        with self._lock:
+            self._records[record.display_name] = record
+            self._closed.pop(record.display_name, None)
+            if record.is_closed():
+                self._closed[record.display_name] = record.updated
+            self._evict()
+
+    # Records are expected in the order they were sent (e.g. when loaded from the database)
+    def put_all(self, records):
+        with self._lock:
+            for record in records:
+                self._records[record.display_name] = record
+                self._closed.pop(record.display_name, None)
+                if record.is_closed():
+                    self._closed[record.display_name] = record.updated
+            self._evict()
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        oldest_allowed = int((time.time() - self.max_closed_age) * 1000)
+        while self._closed:
+            display_name, updated = next(iter(self._closed.items()))
+            if len(self._closed) <= self.max_closed and updated >= oldest_allowed:
+                break
+            del self._closed[display_name]
+            del self._records[display_name]
+            self.evicted += 1
+
+    def stats(self):
+        with self._lock:
+            tracked = len(self._records)
+            closed = len(self._closed)
+            memory = sys.getsizeof(self._records) + sys.getsizeof(self._closed) + \
+                sum(record.size() for record in self._records.values())
+            return {
+                'tracked': tracked,
+                'open': tracked - closed,
+                'closed': closed,
+                'evicted': self.evicted,
+                'memory': memory,
+                'memory_per_problem': float(memory) / tracked if tracked else 0.0,
+            }
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+import timeit
+
+#######################
+# SMS notifications of the problems.
+# The messages are queued and sent by a background thread with a long-lived
+# transport. Repeated notifications of a problem are dropped, problems
+# notified within the digest window are merged in one SMS and the messages
+# sent per minute are limited.
+#######################
+
+
+# Sends the messages with the Twilio client, created once and reused
+class TwilioTransport(object):
+
+    def __init__(self, account, token, from_number, timeout):
+        self.account = account
+        self.token = token
+        self.from_number = from_number
+        self.timeout = timeout
+        self._client = None
+
+    def send(self, to, body):
+        if self._client is None:
+            from twilio.rest import Client
+            self._client = Client(self.account, self.token, http_client=get_twilio_http_client(self.timeout))
+        self._client.messages.create(to=to, from_=self.from_number, body=body)
+
+
+# HTTP client of Twilio with keep-alive connections and a timeout for every request
+def get_twilio_http_client(timeout):
+    from twilio.http.http_client import TwilioHttpClient
+
+    class TimeoutHttpClient(TwilioHttpClient):
+        def request(self, method, url, params=None, data=None, headers=None, auth=None, timeout=None,
+                    allow_redirects=False):
+            return TwilioHttpClient.request(self, method, url, params, data, headers, auth,
+                                            timeout or self.timeout, allow_redirects)
+
+    http_client = TimeoutHttpClient(pool_connections=True)
+    http_client.timeout = timeout
+    return http_client
+
+
+# Sends the messages with plain HTTP calls to the Twilio REST API (or a fake
+# endpoint with the same API, e.g. for benchmarks) over a keep-alive session.
+class HttpTransport(object):
+
+    def __init__(self, account, token, from_number, api_url, timeout):
+        self.url = '{0}/2010-04-01/Accounts/{1}/Messages.json'.format(api_url.rstrip('/'), account)
+        self.from_number = from_number
+        self.timeout = timeout
+        import requests
+        self.session = requests.Session()
+        self.session.auth = (account, token)
+
+    def send(self, to, body):
+        r = self.session.post(self.url, data={'To': to, 'From': self.from_number, 'Body': body}, timeout=self.timeout)
+        if r.status_code >= 300:
+            raise Exception('SMS could not be sent. HTTP CODE[{0}] {1}'.format(r.status_code, r.content))
+
+
+class SmsDispatcher(object):
+
+    def __init__(self, transport, recipients, message_function, digest_window, dedupe_window, rate_limit,
+                 sent_function=None, target=None, failed_function=None, histogram=None):
+        self.transport = transport
+        # The duration of every message sent (with its retries) is observed in the histogram if given
+        self.histogram = histogram
+        # The messages are sent through the resilience target (retries and circuit breaker) if given
+        self.target = target
+        self.recipients = recipients
+        # message_function(problems) returns the body of the SMS for one or more problems
+        self.message_function = message_function
+        self.digest_window = digest_window
+        self.dedupe_window = dedupe_window
+        # Minimum seconds between two messages (rate_limit messages per minute, 0 = no limit)
+        self.send_interval = 60.0 / rate_limit if rate_limit else 0.0
+        # sent_function(problems, recipients) is called after the SMS has been sent
+        self.sent_function = sent_function
+        # failed_function(problems, to, error) is called when the SMS could not be sent
+        self.failed_function = failed_function
+        self._queue = []
+        self._first_queued = None
+        self._notified = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._sending = False
+        self._last_send = 0.0
+        self.queued = 0
+        self.deduplicated = 0
+        self.sent = 0
+        self.digests = 0
+        self.failed = 0
+
+    # Queues the SMS for the problem unless it was already notified with the same status
+    def notify(self, problem_details):
+        key = (problem_details['id'], problem_details['status'])
+        now = time.time()
+        with self._condition:
+            notified_at = self._notified.get(key)
+            if notified_at is not None and now - notified_at < self.dedupe_window:
+                self.deduplicated += 1
+                logging.info('SMS for problem %s (%s) already sent, skipped', problem_details['displayName'],
+                             problem_details['status'])
+                return False
+            self._forget_notified(now)
+            self._notified[key] = now
+            if not self._queue:
+                self._first_queued = timeit.default_timer()
+            self._queue.append(problem_details)
+            self.queued += 1
+            self._start()
+            self._condition.notify()
+        return True
+
+    def _forget_notified(self, now):
+        expired = [key for key, notified_at in self._notified.items() if now - notified_at >= self.dedupe_window]
+        for key in expired:
+            del self._notified[key]
+
+    # The thread is started again if it died
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._work, name='sms-dispatcher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                # Wait for the digest window, more problems can come meanwhile
+                remaining = self._first_queued + self.digest_window - timeit.default_timer()
+                while remaining > 0:
+                    self._condition.wait(remaining)
+                    remaining = self._first_queued + self.digest_window - timeit.default_timer()
+                problems = self._queue
+                self._queue = []
+                self._sending = True
+            try:
+                self._send(problems)
+            except Exception:
+                # The thread goes on with the next messages
+                logging.error('SMS for problems %s could not be sent', ', '.join(p['displayName'] for p in problems),
+                              exc_info=True)
+            finally:
+                with self._condition:
+                    self._sending = False
+                    self._condition.notify_all()
+
+    def _send(self, problems):
+        body = self.message_function(problems)
+        recipients = []
+        for to in self.recipients:
+            wait = self._last_send + self.send_interval - timeit.default_timer()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_send = timeit.default_timer()
+            try:
+                self.send(to, body)
+                recipients.append(to)
+            except Exception as e:
+                with self._condition:
+                    self.failed += 1
+                logging.error('SMS to %s could not be sent', to)
+                logging.debug("Traceback of the error", exc_info=True)
+                self._fail(problems, to, e)
+        if not recipients:
+            return
+        with self._condition:
+            self.sent += len(recipients)
+            if len(problems) > 1:
+                self.digests += 1
+        if self.sent_function is not None:
+            try:
+                self.sent_function(problems, recipients)
+            except Exception:
+                logging.error('Error after sending the SMS to %s', ', '.join(recipients), exc_info=True)
+
+    # Gives the SMS to the failed function. Its errors (e.g. the database is locked) are logged,
+    # so the other recipients still get the SMS.
+    def _fail(self, problems, to, error):
+        if self.failed_function is None:
+            return
+        try:
+            self.failed_function(problems, to, error)
+        except Exception:
+            logging.error('The SMS to %s is lost', to, exc_info=True)
+
+    def send(self, to, body):
+        started_at = timeit.default_timer()
+        try:
+            if self.target is None:
+                self.transport.send(to, body)
+            else:
+                self.target.call(self.transport.send, to, body)
+        finally:
+            if self.histogram is not None:
+                self.histogram.observe(timeit.default_timer() - started_at)
+
+    # Sends the queued messages now and waits (up to timeout seconds) until they are sent
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else timeit.default_timer() + timeout
+        with self._condition:
+            if self._queue:
+                self._first_queued -= self.digest_window
+                self._condition.notify_all()
+            while self._queue or self._sending:
+                remaining = None if deadline is None else deadline - timeit.default_timer()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    # Flush at exit: the messages still queued after timeout seconds are given to the failed
+    # function (for every recipient) instead of being lost with the process. Returns True if
+    # all the messages were sent.
+    def close(self, timeout):
+        if self.flush(timeout):
+            return True
+        with self._condition:
+            problems = self._queue
+            self._queue = []
+        if problems:
+            for to in self.recipients:
+                self._fail(problems, to, 'Not sent before exit')
+        return False
+
+    def stats(self):
+        with self._condition:
+            return {
+                'queued': len(self._queue),
+                'notified': self.queued,
+                'deduplicated': self.deduplicated,
+                'sent': self.sent,
+                'digests': self.digests,
+                'failed': self.failed,
+            }
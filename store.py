@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from os.path import isfile, join
+
+#######################
+# Embedded store of the received notifications and the sent problems.
+# It is a SQLite database in WAL mode, so readers do not block the writer
+# and a write costs an append to the log instead of a file per problem.
+# Each thread gets its own connection to the database. Several worker
+# processes can share the database: the state they must agree on
+# (counters, repeated notifications, leases) is updated atomically.
+#######################
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS problems_sent (
+    display_name TEXT PRIMARY KEY,
+    pid TEXT NOT NULL,
+    status TEXT NOT NULL,
+    start_time INTEGER,
+    end_time INTEGER,
+    updated INTEGER NOT NULL,
+    details TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS problems_sent_pid ON problems_sent (pid);
+CREATE INDEX IF NOT EXISTS problems_sent_status ON problems_sent (status);
+CREATE INDEX IF NOT EXISTS problems_sent_start_time ON problems_sent (start_time);
+CREATE INDEX IF NOT EXISTS problems_sent_updated ON problems_sent (updated);
+
+CREATE TABLE IF NOT EXISTS problems_received (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    problem_nr TEXT NOT NULL,
+    pid TEXT,
+    state TEXT,
+    received INTEGER NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS problems_received_problem_nr ON problems_received (problem_nr);
+CREATE INDEX IF NOT EXISTS problems_received_pid ON problems_received (pid);
+CREATE INDEX IF NOT EXISTS problems_received_received ON problems_received (received);
+
+CREATE TABLE IF NOT EXISTS retry_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS retry_queue_next_attempt ON retry_queue (next_attempt);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS archive_index (
+    problem_nr TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    segment TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS archive_index_problem_nr ON archive_index (problem_nr);
+CREATE INDEX IF NOT EXISTS archive_index_segment ON archive_index (segment);
+
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# Rows written in one transaction when migrating the JSON directories
+MIGRATION_BATCH_SIZE = 1000
+# Rows read at once when a large amount of notifications is iterated
+READ_BATCH_SIZE = 1000
+
+
+# Current time in milliseconds, like the timestamps of the Dynatrace API
+def now_millis():
+    return int(time.time() * 1000)
+
+
+class ProblemStore(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    # Connection of the calling thread
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # In WAL mode the database stays consistent with NORMAL and the
+            # log is not synced on every commit.
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    # Transaction taking the write lock at the start, so what is read in it cannot be
+    # changed by another thread or process before it is written
+    @contextmanager
+    def write_transaction(self):
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # Sent problems (full problem details, one row per problem number)
+
+    def save_problem(self, problem_details):
+        self.save_problems([problem_details])
+
+    def save_problems(self, problems):
+        updated = now_millis()
+        rows = [(p['displayName'], p['id'], p['status'], p.get('startTime'), p.get('endTime'), updated, json.dumps(p))
+                for p in problems]
+        with self.connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO problems_sent '
+                             '(display_name, pid, status, start_time, end_time, updated, details) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def get_problem(self, display_name):
+        row = self.connection().execute('SELECT details FROM problems_sent WHERE display_name = ?',
+                                        (display_name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Returns the details of the sent problems, optionally filtered by status
+    # and by start time (milliseconds), ordered by start time.
+    def find_problems(self, status=None, start_from=None, start_to=None):
+        query, params = self._where('SELECT details FROM problems_sent', [
+            ('status = ?', status), ('start_time >= ?', start_from), ('start_time < ?', start_to)])
+        cursor = self.connection().execute(query + ' ORDER BY start_time', params)
+        for row in cursor:
+            yield json.loads(row[0])
+
+    # Compact index of the sent problems: (display_name, pid, status, start_time, end_time, updated)
+    # in the order they were sent. It is read with one query from the indexed columns,
+    # without decoding the details, and is kept up to date by save_problems.
+    def load_index(self):
+        return self.connection().execute(
+            'SELECT display_name, pid, status, start_time, end_time, updated FROM problems_sent '
+            'ORDER BY updated').fetchall()
+
+    # Returns (display_name, updated) of a page of the sent problems ordered by start time
+    def load_index_page(self, offset, limit, newest_first=True):
+        order = 'DESC' if newest_first else 'ASC'
+        return self.connection().execute(
+            'SELECT display_name, updated FROM problems_sent ORDER BY start_time {0}, display_name {0} '
+            'LIMIT ? OFFSET ?'.format(order), (limit, offset)).fetchall()
+
+    def get_index_row(self, display_name):
+        return self.connection().execute(
+            'SELECT display_name, pid, status, start_time, end_time, updated FROM problems_sent '
+            'WHERE display_name = ?', (display_name,)).fetchone()
+
+    def count_problems(self):
+        return self.connection().execute('SELECT COUNT(*) FROM problems_sent').fetchone()[0]
+
+    # Received notifications (raw payload, one row per notification)
+
+    def add_notification(self, payload, received=None):
+        self.add_notifications([payload], received)
+
+    def add_notifications(self, payloads, received=None):
+        if received is None:
+            received = now_millis()
+        rows = [(p['ProblemID'], p.get('PID'), p.get('State'), received, json.dumps(p, ensure_ascii=False))
+                for p in payloads]
+        self._insert_notifications(rows)
+
+    # Adds the notification unless one with the same PID and State was received since
+    # received_from (milliseconds). Returns the id of the notification, None if it is a repeated one.
+    def add_notification_once(self, payload, received_from, received=None):
+        if received is None:
+            received = now_millis()
+        with self.write_transaction() as conn:
+            if conn.execute('SELECT 1 FROM problems_received WHERE pid = ? AND state = ? AND received >= ? LIMIT 1',
+                            (payload.get('PID'), payload.get('State'), received_from)).fetchone():
+                return None
+            return conn.execute('INSERT INTO problems_received (problem_nr, pid, state, received, payload) '
+                                'VALUES (?, ?, ?, ?, ?)',
+                                (payload['ProblemID'], payload.get('PID'), payload.get('State'), received,
+                                 json.dumps(payload, ensure_ascii=False))).lastrowid
+
+    # Removes a notification that could not be processed, so a new delivery is not taken as repeated
+    def delete_notification(self, notification_id):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM problems_received WHERE id = ?', (notification_id,))
+
+    def _insert_notifications(self, rows):
+        with self.connection() as conn:
+            conn.executemany('INSERT INTO problems_received (problem_nr, pid, state, received, payload) '
+                             'VALUES (?, ?, ?, ?, ?)', rows)
+
+    # (received, payload) of the notifications received in the time range (milliseconds), oldest first.
+    # They are read in batches after the last row read, so a large backlog is neither held in
+    # memory nor read in one long transaction blocking the checkpoints of the database.
+    def iter_notifications(self, received_from=None, received_to=None, batch_size=READ_BATCH_SIZE):
+        last = None
+        while True:
+            query, params = self._where('SELECT id, received, payload FROM problems_received', [
+                ('received >= ?', received_from), ('received < ?', received_to)])
+            if last is not None:
+                query += ' AND ' if params else ' WHERE '
+                query += '(received > ? OR (received = ? AND id > ?))'
+                params.extend([last[1], last[1], last[0]])
+            rows = self.connection().execute(query + ' ORDER BY received, id LIMIT ?', params + [batch_size]).fetchall()
+            for row_id, received, payload in rows:
+                yield received, json.loads(payload)
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][:2]
+
+    # (pid, state, received) of the notifications received since the time (milliseconds), oldest first
+    def load_notifications_index(self, received_from):
+        return self.connection().execute(
+            'SELECT pid, state, received FROM problems_received WHERE received >= ? ORDER BY received, id',
+            (received_from,)).fetchall()
+
+    def count_notifications(self, received_from=None, received_to=None):
+        query, params = self._where('SELECT COUNT(*) FROM problems_received', [
+            ('received >= ?', received_from), ('received < ?', received_to)])
+        return self.connection().execute(query, params).fetchone()[0]
+
+    def _where(self, query, conditions):
+        clauses = []
+        params = []
+        for clause, value in conditions:
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        return query, params
+
+    # Work parked to be retried later (next_attempt in seconds since the epoch)
+
+    def add_retry(self, kind, payload, next_attempt):
+        with self.connection() as conn:
+            conn.execute('INSERT INTO retry_queue (kind, payload, attempts, next_attempt) VALUES (?, ?, 0, ?)',
+                         (kind, payload, next_attempt))
+
+    # Returns (id, kind, payload, attempts) of the work due at the time, oldest first
+    def load_due_retries(self, now, limit=100):
+        return self.connection().execute(
+            'SELECT id, kind, payload, attempts FROM retry_queue WHERE next_attempt <= ? '
+            'ORDER BY next_attempt LIMIT ?', (now, limit)).fetchall()
+
+    def reschedule_retry(self, retry_id, attempts, next_attempt):
+        with self.connection() as conn:
+            conn.execute('UPDATE retry_queue SET attempts = ?, next_attempt = ? WHERE id = ?',
+                         (attempts, next_attempt, retry_id))
+
+    def delete_retry(self, retry_id):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM retry_queue WHERE id = ?', (retry_id,))
+
+    def count_retries(self):
+        return self.connection().execute('SELECT COUNT(*) FROM retry_queue').fetchone()[0]
+
+    # Values kept between runs (e.g. the cursor of the incremental poll)
+
+    def get_value(self, key, default=None):
+        row = self.connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_value(self, key, value):
+        with self.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    # Archive of the old notifications and sent problems in segment files
+
+    # (id, problem_nr, received, payload) of the oldest notifications received before the time (milliseconds)
+    def load_archivable_notifications(self, received_before, limit):
+        return self.connection().execute(
+            'SELECT id, problem_nr, received, payload FROM problems_received WHERE received < ? '
+            'ORDER BY received, id LIMIT ?', (received_before, limit)).fetchall()
+
+    # (display_name, updated, details) of the oldest closed problems sent before the time (milliseconds)
+    def load_archivable_problems(self, updated_before, limit):
+        return self.connection().execute(
+            "SELECT display_name, updated, details FROM problems_sent WHERE status != 'OPEN' AND updated < ? "
+            'ORDER BY updated LIMIT ?', (updated_before, limit)).fetchall()
+
+    # Indexes the notifications written in the segment and deletes them from the database
+    def archive_notifications(self, rows, segment):
+        with self.connection() as conn:
+            conn.executemany("INSERT INTO archive_index (problem_nr, kind, segment) VALUES (?, 'received', ?)",
+                             [(row[1], segment) for row in rows])
+            conn.executemany('DELETE FROM problems_received WHERE id = ?', [(row[0],) for row in rows])
+
+    # Indexes the problems written in the segment and deletes them from the database
+    def archive_problems(self, rows, segment):
+        with self.connection() as conn:
+            conn.executemany("INSERT INTO archive_index (problem_nr, kind, segment) VALUES (?, 'sent', ?)",
+                             [(row[0], segment) for row in rows])
+            conn.executemany('DELETE FROM problems_sent WHERE display_name = ? AND updated = ?',
+                             [(row[0], row[1]) for row in rows])
+
+    # Segments with archived notifications or details of the problem number
+    def find_archive_segments(self, problem_nr):
+        return [row[0] for row in self.connection().execute(
+            'SELECT DISTINCT segment FROM archive_index WHERE problem_nr = ? ORDER BY segment', (problem_nr,))]
+
+    def delete_archive_segment(self, segment):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM archive_index WHERE segment = ?', (segment,))
+
+    # Counters shared by the worker processes
+
+    def increment_counter(self, name, amount=1):
+        with self.write_transaction() as conn:
+            if conn.execute('UPDATE counters SET value = value + ? WHERE name = ?', (amount, name)).rowcount == 0:
+                conn.execute('INSERT INTO counters (name, value) VALUES (?, ?)', (name, amount))
+
+    def get_counter(self, name):
+        row = self.connection().execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    # Takes (or renews) the lease of a task for ttl seconds. Returns False while
+    # another owner holds it, so only one worker process runs the task.
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        with self.write_transaction() as conn:
+            row = conn.execute('SELECT owner, expires FROM leases WHERE name = ?', (name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            conn.execute('INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)',
+                         (name, owner, now + ttl))
+        return True
+
+    # Gives the lease up if the owner holds it, so another owner can take it now
+    def release_lease(self, name, owner):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+
+    # Takes up to wanted tokens of a rate bucket shared by the processes, refilled with rate
+    # tokens per second up to burst. Returns the tokens taken and the seconds until the next one.
+    def take_rate_tokens(self, name, wanted, rate, burst):
+        now = time.time()
+        with self.write_transaction() as conn:
+            row = conn.execute('SELECT tokens, updated FROM rate_buckets WHERE name = ?', (name,)).fetchone()
+            tokens, updated = row if row is not None else (float(burst), now)
+            if now > updated:
+                tokens = min(burst, tokens + (now - updated) * rate)
+                updated = now
+            taken = min(wanted, int(tokens))
+            tokens -= taken
+            conn.execute('INSERT OR REPLACE INTO rate_buckets (name, tokens, updated) VALUES (?, ?, ?)',
+                         (name, tokens, updated))
+        # updated is in the future while the bucket is paused
+        return taken, (updated - now) + max(0.0, 1 - tokens) / rate
+
+    # Empties the rate bucket, it is refilled again after the time until (seconds since the epoch)
+    def pause_rate_tokens(self, name, until):
+        with self.write_transaction() as conn:
+            row = conn.execute('SELECT updated FROM rate_buckets WHERE name = ?', (name,)).fetchone()
+            conn.execute('INSERT OR REPLACE INTO rate_buckets (name, tokens, updated) VALUES (?, 0, ?)',
+                         (name, max(until, row[0]) if row is not None else until))
+
+    # Import of the JSON files written by previous versions in
+    # dir_received (<ProblemID>-<State>.json) and dir_sent (<displayName>.json).
+    # The time a notification was received or a problem sent is taken from the file. It can
+    # be run again: the notifications and sent problems already in the database are kept.
+    def migrate(self, dir_received, dir_sent):
+        received = 0
+        rows = []
+        for filename, path in self._list_json_files(dir_received):
+            with open(path, 'r') as f:
+                payload = json.load(f)
+            rows.append((payload['ProblemID'], payload.get('PID'), payload.get('State'),
+                         int(os.path.getmtime(path) * 1000), json.dumps(payload, ensure_ascii=False)))
+            if len(rows) >= MIGRATION_BATCH_SIZE:
+                received += self._insert_new_notifications(rows)
+                rows = []
+        received += self._insert_new_notifications(rows)
+
+        sent = 0
+        rows = []
+        for filename, path in self._list_json_files(dir_sent):
+            with open(path, 'r') as f:
+                p = json.load(f)
+            rows.append((p['displayName'], p['id'], p['status'], p.get('startTime'), p.get('endTime'),
+                         int(os.path.getmtime(path) * 1000), json.dumps(p)))
+            if len(rows) >= MIGRATION_BATCH_SIZE:
+                sent += self._insert_new_problems(rows)
+                rows = []
+        sent += self._insert_new_problems(rows)
+        logging.info("Migrated %s received notifications from '%s' and %s sent problems from '%s' to '%s'",
+                     received, dir_received, sent, dir_sent, self.filename)
+        return received, sent
+
+    # Inserts the rows unless a notification with the same problem number, PID, state and time
+    # received is already stored. Returns the number of rows inserted.
+    def _insert_new_notifications(self, rows):
+        inserted = 0
+        with self.write_transaction() as conn:
+            for row in rows:
+                if conn.execute('SELECT 1 FROM problems_received WHERE problem_nr = ? AND pid IS ? AND state IS ? '
+                                'AND received = ? LIMIT 1', row[:4]).fetchone():
+                    continue
+                conn.execute('INSERT INTO problems_received (problem_nr, pid, state, received, payload) '
+                             'VALUES (?, ?, ?, ?, ?)', row)
+                inserted += 1
+        return inserted
+
+    # Inserts the sent problems not in the database yet: the rows written since by the
+    # webhook are newer than the files. Returns the number of rows inserted.
+    def _insert_new_problems(self, rows):
+        inserted = 0
+        with self.write_transaction() as conn:
+            for row in rows:
+                inserted += conn.execute('INSERT OR IGNORE INTO problems_sent '
+                                         '(display_name, pid, status, start_time, end_time, updated, details) '
+                                         'VALUES (?, ?, ?, ?, ?, ?, ?)', row).rowcount
+        return inserted
+
+    def _list_json_files(self, directory):
+        if not os.path.isdir(directory):
+            return []
+        return [(f, join(directory, f)) for f in sorted(os.listdir(directory))
+                if f.endswith('.json') and isfile(join(directory, f))]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
+
+#######################
+# Tenants served by one webhook process.
+# Every tenant has its own components: API client and rate limit, ingest
+# queue and workers, caches, sent problems, database, retry queue... so a
+# storm of notifications of one tenant does not slow down the others.
+# The webhook reaches the components of the current tenant through
+# proxies with the usual global names (STORE, DT_CLIENT...). The current
+# tenant is set per thread, like the request of Flask: by the webserver
+# for each request and by the threads of a tenant (ingest workers, comment
+# outbox, periodic tasks) for their own tenant. Threads without a tenant
+# use the default one.
+#######################
+
+_current = threading.local()
+
+
+class Tenant(object):
+
+    # The components are set as attributes by the webhook when the tenant is created
+    def __init__(self, name, host, api_token, username, password):
+        self.name = name
+        self.host = host
+        self.api_token = api_token
+        self.username = username
+        self.password = password
+
+    def is_authorized(self, username, password):
+        return username == self.username and password == self.password
+
+    # The tenant is the current one of the calling thread within the block
+    @contextmanager
+    def activate(self):
+        previous = getattr(_current, 'tenant', None)
+        _current.tenant = self
+        try:
+            yield self
+        finally:
+            _current.tenant = previous
+
+    # Returns the function running with this tenant as the current one, for the
+    # functions called by the threads of the components (workers, tasks...)
+    def bind(self, function):
+        def run(*args, **kwargs):
+            with self.activate():
+                return function(*args, **kwargs)
+        return run
+
+
+class TenantRegistry(object):
+
+    def __init__(self):
+        self._tenants = []
+        self.default = None
+
+    # The first tenant added is the default one
+    def add(self, tenant):
+        if self.get(tenant.name) is not None:
+            raise ValueError("Tenant '{0}' is configured twice".format(tenant.name))
+        self._tenants.append(tenant)
+        if self.default is None:
+            self.default = tenant
+
+    def get(self, name):
+        for tenant in self._tenants:
+            if tenant.name == name:
+                return tenant
+        return None
+
+    # Tenant of the basic authentication credentials of a request
+    def find_by_credentials(self, username, password):
+        for tenant in self._tenants:
+            if tenant.is_authorized(username, password):
+                return tenant
+        return None
+
+    def current(self):
+        return getattr(_current, 'tenant', None) or self.default
+
+    def __iter__(self):
+        return iter(list(self._tenants))
+
+    def __len__(self):
+        return len(self._tenants)
+
+
+# Component (attribute) of the current tenant
+class TenantProxy(object):
+
+    def __init__(self, registry, attribute):
+        self._registry = registry
+        self._attribute = attribute
+
+    def get_object(self):
+        return getattr(self._registry.current(), self._attribute)
+
+    def __getattr__(self, name):
+        return getattr(self.get_object(), name)
+
+    def __len__(self):
+        return len(self.get_object())
+
+    def __repr__(self):
+        return '<TenantProxy {0}>'.format(self._attribute)
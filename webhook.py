@@ -1,24 +1,37 @@
 # -*- coding: utf-8 -*-
 # Required Libraries.
 from __future__ import print_function
-from flask import Flask, request, flash, render_template
-from flask import Markup
-from flask_basicauth import BasicAuth
 from datetime import timedelta
-from os import listdir
-from os.path import isfile, join
-from twilio.rest import Client
+import calendar
 import getpass
 import sys
 import os
 import datetime
 import json
 import socket
+import threading
 import timeit
+import gzip
 import logging
-import subprocess
-import requests
-import traceback
+import shutil
+from logging.handlers import RotatingFileHandler
+from logpipeline import JsonFormatter, LogPipeline
+import atexit
+from archive import SegmentArchive
+from cache import TTLCache
+from dedupe import DedupeIndex
+from dtclient import DynatraceClient, iter_feed_problems
+from governor import RateGovernor, SharedBucket
+from incident import CoprocessPool, IncidentExecutor
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsRegistry
+from outbox import CommentOutbox
+from resilience import RetryQueue, Target
+from scheduler import PeriodicTask
+from sms import HttpTransport, SmsDispatcher, TwilioTransport
+from sentproblems import ProblemRecord, SentProblems
+from store import ProblemStore, now_millis
+from tenants import Tenant, TenantProxy, TenantRegistry
+from workqueue import WorkQueue, QueueFullError
 
 #######################
 # Dynatrace Webhook API Custom Integration 
@@ -32,8 +45,8 @@ import traceback
 # Uptime variable
 start_time = timeit.default_timer()
 
-# Problems received variable
-prob_count = 0
+# Name of the counter of received notifications, shared by the worker processes in the database
+RECEIVED_COUNTER = 'notifications_received'
 
 # API Endpoints 
 API_ENDPOINT_PROBLEM_DETAILS = "/api/v1/problem/details/"
@@ -43,15 +56,29 @@ UI_PROBLEM_DETAIL_BY_ID = "/#problems/problemdetails;pid="
 # Time intervals to poll prob_count via API
 RELATIVETIMES = ['hour', '2hours', '6hours', 'day', 'week', 'month']
 
-# JSON Files in memory
-PROBLEMS_SENT = {}
-
 # Read Configuration and assign the variables
 config = json.load(open('config.json'))
 
 # Tenant variables
 TENANT_HOST = config['dynatrace']['tenant']
 API_TOKEN = config['dynatrace']['api_token']
+# Connections kept alive to the tenant, time to wait for a free one and timeouts (in seconds) of the API calls
+API_POOL_SIZE = config['dynatrace']['pool_size']
+API_POOL_TIMEOUT = config['dynatrace']['pool_timeout']
+API_CONNECT_TIMEOUT = config['dynatrace']['connect_timeout']
+API_READ_TIMEOUT = config['dynatrace']['read_timeout']
+# Requests per minute allowed by the API token (0 = no limit), requests allowed at once
+# and seconds to pause when Dynatrace answers 429 without a Retry-After header
+API_RATE_LIMIT = config['dynatrace']['rate_limit']
+API_RATE_BURST = config['dynatrace']['rate_burst']
+API_RETRY_AFTER = config['dynatrace']['retry_after']
+# Lanes of the API calls, highest priority first
+API_LANES = ('details', 'comments', 'feed')
+
+# More tenants served by the same process, each one with its own credentials and components
+# (see tenants in config.json). The tenant of the dynatrace and webhook sections is the default one.
+DEFAULT_TENANT = 'default'
+TENANTS_CONFIG = config['tenants']
 
 # Basic Authorization
 USERNAME = config['webhook']['username']
@@ -63,25 +90,135 @@ WEBHOOK_INTERFACE = config['webhook']['interface']
 WEBHOOK_PORT = config['webhook']['port']
 WEBHOOK_USERNAME = getpass.getuser()
 
+# CLOSED problems kept in memory (at most max_closed and for max_closed_age seconds)
+SENT_MAX_CLOSED = config['sent_problems']['max_closed']
+SENT_MAX_CLOSED_AGE = config['sent_problems']['max_closed_age']
+
+# Notifications with the same PID and State received within window seconds are
+# answered without calling the integrations (at most max_entries are remembered)
+DEDUPE_WINDOW = config['dedupe']['window']
+DEDUPE_MAX_ENTRIES = config['dedupe']['max_entries']
+
+# Problem details are cached by PID to avoid fetching them again
+PROBLEM_CACHE_MAX_ENTRIES = config['problem_cache']['max_entries']
+PROBLEM_CACHE_TTL = config['problem_cache']['ttl']
+
+# Sent problems shown per page in the dashboard and rendered rows kept in memory
+DASHBOARD_PAGE_SIZE = config['dashboard']['page_size']
+DASHBOARD_ROW_CACHE_SIZE = config['dashboard']['row_cache_size']
+DASHBOARD_ROW_CACHE_TTL = config['dashboard']['row_cache_ttl']
+
+# Use the problems of the feed when polling instead of fetching their details
+POLL_REUSE_FEED = config['poll']['reuse_feed']
+# The incremental poll asks only for the time since the last poll. The window starts
+# overlap seconds earlier to cover the delay of the problems in the feed.
+POLL_INCREMENTAL_OVERLAP = config['poll']['incremental_overlap']
+# Interval in seconds of the scheduled incremental poll, random seconds added to each
+# interval and if the webserver also runs the scheduled poll
+POLL_INTERVAL = config['poll']['interval']
+POLL_JITTER = config['poll']['jitter']
+POLL_IN_WEBSERVER = config['poll']['in_webserver']
+# Key of the database value with the end (milliseconds) of the last incremental poll
+POLL_CURSOR_KEY = 'poll_cursor'
+
+# Comments for the same problem within window seconds are posted as one comment.
+# Failed posts are tried max_attempts times, waiting retry_delay seconds (doubled each time).
+COMMENTS_WINDOW = config['comments']['window']
+COMMENTS_MAX_ATTEMPTS = config['comments']['max_attempts']
+COMMENTS_RETRY_DELAY = config['comments']['retry_delay']
+# Comments waiting at most, the next ones are parked in the retry queue. The comments of different
+# problems are posted at the same time, with as many threads as connections to the tenant (pool_size).
+COMMENTS_MAX_PENDING = config['comments']['max_pending']
+
 # Program to call with the notification
 EXEC_WIN = config['incident_notification']['exec_win']
 EXEC_UNIX = config['incident_notification']['exec_unix']
 INCIDENT_NOTIFICATION = config['incident_notification']['active']
+# Calls made at the same time, timeout in seconds of each call and
+# amount of arguments (ranked impacts) sent in one call
+INCIDENT_PARALLELISM = config['incident_notification']['parallelism']
+INCIDENT_TIMEOUT = config['incident_notification']['timeout']
+INCIDENT_BATCH_SIZE = config['incident_notification']['batch_size']
+# 'spawn' starts the executable for every call, 'coprocess' sends the records to
+# long-lived workers of the Incident Software (one per parallel call) checked every health_interval seconds
+INCIDENT_MODE = config['incident_notification']['mode']
+WORKER_WIN = config['incident_notification']['worker_win']
+WORKER_UNIX = config['incident_notification']['worker_unix']
+INCIDENT_HEALTH_INTERVAL = config['incident_notification']['health_interval']
 
 SMS_NOTIFICATION = config['sms_notification']['active']
 TWILIO_ACCOUNT = config['sms_notification']['twilio_account']
 TWILIO_TOKEN = config['sms_notification']['twilio_token']
 TWILIO_NUMBER = config['sms_notification']['twilio_number']
 TO_NUMBER = config['sms_notification']['to_number']
+# Transport of the messages: 'twilio' (Twilio client) or 'http' (plain calls to api_url,
+# the Twilio REST API or a fake endpoint with the same API)
+SMS_TRANSPORT = config['sms_notification']['transport']
+SMS_API_URL = config['sms_notification']['api_url']
+# Problems notified within digest_window seconds are sent in one SMS, a problem is notified
+# only once per status within dedupe_window seconds and at most rate_limit SMS are sent per minute (0 = no limit)
+SMS_DIGEST_WINDOW = config['sms_notification']['digest_window']
+SMS_DEDUPE_WINDOW = config['sms_notification']['dedupe_window']
+SMS_RATE_LIMIT = config['sms_notification']['rate_limit']
+# Seconds to wait for the answer of Twilio
+SMS_TIMEOUT = config['sms_notification']['timeout']
 
 LOGFILE = config['log_file']
 LOGDIR = config['log_dir']
-
-# Directory where the received JSON Problems are saved
+# The log file is rotated after log_max_bytes, log_backup_count compressed files are kept
+LOG_MAX_BYTES = config['log_max_bytes']
+LOG_BACKUP_COUNT = config['log_backup_count']
+# Log records written as JSON objects (one per line) in the log file, otherwise as text
+LOG_JSON = config['log_json']
+# Log records waiting to be written by the background writer, more are dropped
+LOG_QUEUE_SIZE = config['log_queue_size']
+
+# Database where the received notifications and the sent problems (full details of the problem) are saved
+STORE_FILE = config['store_file']
+# Directories where previous versions saved the received and sent problems as JSON files.
+# They are imported in the database with the migrate command.
 DIR_RECEIVED = config['dir_received']
-# Directory where the sent Problems are saved (full details of the problem)
 DIR_SENT = config['dir_sent']
 
+# Retries (attempts, backoff in seconds) and circuit breaker (failures opening it, seconds
+# until it is tried again) for each outbound target: dynatrace, twilio and incident
+RESILIENCE = config['resilience']
+# Work that could not be done is parked in the database and retried every interval seconds,
+# at most max_attempts times (waiting from base_delay up to max_delay seconds between attempts)
+RETRY_QUEUE_INTERVAL = config['retry_queue']['interval']
+RETRY_QUEUE_MAX_ATTEMPTS = config['retry_queue']['max_attempts']
+RETRY_QUEUE_BASE_DELAY = config['retry_queue']['base_delay']
+RETRY_QUEUE_MAX_DELAY = config['retry_queue']['max_delay']
+
+# Received notifications are queued and processed by a pool of workers
+INGEST_WORKERS = config['ingest_queue']['workers']
+INGEST_MAX_SIZE = config['ingest_queue']['max_size']
+# Seconds Dynatrace is asked to wait before retrying when the queue is full
+INGEST_RETRY_AFTER = config['ingest_queue']['retry_after']
+
+# Threads and open connections of the production server (serve command)
+SERVER_THREADS = config['server']['threads']
+SERVER_CONNECTION_LIMIT = config['server']['connection_limit']
+
+# Notifications and closed problems older than keep_days are moved from the database to compressed
+# segment files in the archive directory every interval seconds. A segment is rotated after
+# segment_max_bytes or segment_max_age seconds and deleted after retention_days.
+# The closed problems must stay in the database longer than the longest poll (a month), otherwise
+# polling them would send them again, so keep_days is at least ARCHIVE_MIN_KEEP_DAYS.
+ARCHIVE_DIR = config['archive']['directory']
+ARCHIVE_MIN_KEEP_DAYS = 31
+ARCHIVE_KEEP_DAYS = max(config['archive']['keep_days'], ARCHIVE_MIN_KEEP_DAYS)
+ARCHIVE_SEGMENT_MAX_BYTES = config['archive']['segment_max_bytes']
+ARCHIVE_SEGMENT_MAX_AGE = config['archive']['segment_max_age']
+ARCHIVE_RETENTION_DAYS = config['archive']['retention_days']
+ARCHIVE_INTERVAL = config['archive']['interval']
+
+# Workers calling the integrations and notifications read ahead when replaying the received notifications
+REPLAY_CONCURRENCY = config['replay']['concurrency']
+REPLAY_QUEUE_SIZE = config['replay']['queue_size']
+# Formats of the time range of the replay (UTC)
+REPLAY_TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S')
+
 
 def check_create_dir(dir_name):
     if not os.path.exists(dir_name):
@@ -90,67 +227,216 @@ def check_create_dir(dir_name):
 # Logging configuration
 # Create log directory at initialization
 check_create_dir(LOGDIR)
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', filename=LOGDIR + '/' + LOGFILE,
-                    level=logging.INFO)
 
-# Add logging also to the console of the running program
-logging.getLogger().addHandler(logging.StreamHandler())
+
+# The rotated log files are compressed
+def compress_log(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def get_log_handler():
+    handler = RotatingFileHandler(LOGDIR + '/' + LOGFILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    handler.namer = lambda name: name + '.gz'
+    handler.rotator = compress_log
+    if LOG_JSON:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    return handler
+
+
+# The records are written to the log file and the console of the running program by a background
+# thread. The tokens and passwords of the configuration are redacted.
+LOG_PIPELINE = LogPipeline([get_log_handler(), logging.StreamHandler()], LOG_QUEUE_SIZE,
+                           [API_TOKEN, PASSWORD, TWILIO_TOKEN] +
+                           [settings[key] for settings in TENANTS_CONFIG for key in ('api_token', 'password')])
+LOG_PIPELINE.start(logging.INFO)
+atexit.register(LOG_PIPELINE.stop)
+if config['archive']['keep_days'] < ARCHIVE_MIN_KEEP_DAYS:
+    logging.warning("archive keep_days %s is shorter than the longest poll, %s days are used",
+                    config['archive']['keep_days'], ARCHIVE_MIN_KEEP_DAYS)
 # Set Twilio logging to warning. 
 logging.getLogger("twilio").setLevel(logging.WARNING)
 
 
-# Initiate Flask Microservice with basic authentication
-app = Flask(__name__)
-app.secret_key = "super_secret_key"
-app.config['BASIC_AUTH_USERNAME'] = USERNAME
-app.config['BASIC_AUTH_PASSWORD'] = PASSWORD
+# Tenants served by this process. Every tenant has its own components (created by add_tenant), the
+# webhook uses the ones of the current tenant through the proxies below (STORE, DT_CLIENT...).
+TENANTS = TenantRegistry()
+
+# Received notifications and sent problems
+STORE = TenantProxy(TENANTS, 'store')
+
+# Archive of the old notifications and sent problems
+ARCHIVE = TenantProxy(TENANTS, 'archive')
+
+# Metrics exposed in /metrics. The duration of each stage of the pipeline is observed in a histogram.
+METRICS = MetricsRegistry()
+
+
+def stage_histogram(stage):
+    return METRICS.histogram('webhook_stage_duration_seconds', 'Seconds spent in each stage of the pipeline',
+                             {'stage': stage})
+
+
+def notification_counter(result):
+    return METRICS.counter('webhook_notifications_total', 'Notifications received by result', {'result': result})
 
-# Protect your entire site with basic access authentication,
-# app.config['BASIC_AUTH_FORCE'] = True
-basic_auth = BasicAuth(app)
 
-# Flask listener for POST Method with authorization
-@app.route('/', methods=['POST'])
-@basic_auth.required
-def handle_post():
+PARSE_TIME = stage_histogram('parse')
+SAVE_REQUEST_TIME = stage_histogram('save_request')
+GET_PROBLEM_TIME = stage_histogram('get_problem_by_id')
+INCIDENT_CALL_TIME = stage_histogram('incident_call')
+SMS_SEND_TIME = stage_histogram('sms_send')
+COMMENT_POST_TIME = stage_histogram('comment_post')
+PERSIST_PROBLEM_TIME = stage_histogram('persist_problem')
+NOTIFICATIONS_ACCEPTED = notification_counter('accepted')
+NOTIFICATIONS_TEST = notification_counter('test')
+NOTIFICATIONS_DUPLICATE = notification_counter('duplicate')
+NOTIFICATIONS_INVALID = notification_counter('invalid')
+NOTIFICATIONS_REJECTED = notification_counter('rejected')
+NOTIFICATIONS_ERROR = notification_counter('error')
+
+
+def create_target(name):
+    settings = RESILIENCE[name]
+    return Target(name, settings['attempts'], settings['base_delay'], settings['max_delay'],
+                  settings['failure_threshold'], settings['reset_timeout'])
+
+
+# Outbound targets with retries and circuit breakers. Twilio and the Incident Software
+# are shared by the tenants, every tenant has its own Dynatrace target.
+DT_TARGET = TenantProxy(TENANTS, 'dt_target')
+TWILIO_TARGET = create_target('twilio')
+INCIDENT_TARGET = create_target('incident')
+
+# Work parked to be retried later
+RETRY_QUEUE = TenantProxy(TENANTS, 'retry_queue')
+
+# Notifications received within the dedupe window by (PID, State)
+DEDUPE_INDEX = TenantProxy(TENANTS, 'dedupe_index')
+
+# Sent problems in memory by problem number. Only compact records with the fields needed
+# to detect new problems are kept, the full details are read from the database on demand.
+PROBLEMS_SENT = TenantProxy(TENANTS, 'problems_sent')
+
+
+# Handles the body of a POST request of Dynatrace (the webserver checks the basic
+# authentication). The notification is only validated, persisted and queued, the
+# integrations are called by the workers of the ingest queue. It is answered OK only
+# once it is saved, invalid payloads get 400 and failures 5xx (Dynatrace delivers it again).
+def receive_notification(data, remote_addr):
     try:
-        global prob_count 
-        prob_count += 1
-        problem_simple = json.loads(request.data)
-        logging.info('Notification received from ' + request.remote_addr);
+        STORE.increment_counter(RECEIVED_COUNTER)
+        try:
+            with PARSE_TIME.time():
+                problem_simple = json.loads(data)
+        except ValueError:
+            logging.error("Notification payload is not JSON: %s", data)
+            NOTIFICATIONS_INVALID.inc()
+            return "Invalid notification payload", 400
+        logging.info('Notification received from %s', remote_addr)
+        
+        if not is_valid_notification(problem_simple):
+            logging.error("Invalid notification payload: %s", data)
+            NOTIFICATIONS_INVALID.inc()
+            return "Invalid notification payload", 400
         
-        # JSON Payload will be saved in a directory
-        save_request(problem_simple)
-        if "999" in problem_simple['ProblemID']:
-            logging.info('Test message successfully received. No integration will be called')
+        is_test = "999" in problem_simple['ProblemID']
+        # Repeated deliveries of a notification are answered at once, without calling the integrations
+        if not is_test and not DEDUPE_INDEX.add(problem_simple['PID'], problem_simple['State']):
+            logging.info('Notification %s (%s) already received. No integration will be called',
+                         problem_simple['ProblemID'], problem_simple['State'],
+                         extra={'problem': problem_simple['ProblemID'], 'pid': problem_simple['PID']})
+            NOTIFICATIONS_DUPLICATE.inc()
             return "OK"
         
-        # Integrations will be called
-        call_integration(problem_simple['PID'])
+        notification_id = None
+        try:
+            if is_test:
+                # JSON Payload will be saved in the database
+                save_request(problem_simple)
+                logging.info('Test message successfully received. No integration will be called')
+                NOTIFICATIONS_TEST.inc()
+                return "OK"
+            
+            # The payload is saved unless another worker process received the same notification meanwhile
+            notification_id = save_request_once(problem_simple)
+            if notification_id is None:
+                logging.info('Notification %s (%s) already received by another worker. No integration will be called',
+                             problem_simple['ProblemID'], problem_simple['State'],
+                             extra={'problem': problem_simple['ProblemID'], 'pid': problem_simple['PID']})
+                NOTIFICATIONS_DUPLICATE.inc()
+                return "OK"
+            
+            # Integrations will be called by the ingest workers
+            INGEST_QUEUE.submit(problem_simple)
+            NOTIFICATIONS_ACCEPTED.inc()
+        except Exception:
+            # The notification was not processed, a new delivery must not be taken as a duplicate
+            DEDUPE_INDEX.discard(problem_simple['PID'], problem_simple['State'])
+            if notification_id is not None:
+                STORE.delete_notification(notification_id)
+            raise
         
+    except QueueFullError as e:
+        logging.error("Notification %s rejected: %s", problem_simple['ProblemID'], e,
+                      extra={'problem': problem_simple['ProblemID'], 'pid': problem_simple['PID']})
+        NOTIFICATIONS_REJECTED.inc()
+        return "Ingest queue is full", 503, {'Retry-After': str(INGEST_RETRY_AFTER)}
     except Exception as e:
-        logging.error("There was an error handling the Request")
-        logging.error(traceback.format_exc())
+        # The notification is not persisted nor queued, Dynatrace must deliver it again
+        logging.error("There was an error handling the Request", exc_info=True)
+        NOTIFICATIONS_ERROR.inc()
+        return "The notification could not be saved", 500
     return "OK"
 
 
+def is_valid_notification(problem_simple):
+    if not isinstance(problem_simple, dict):
+        return False
+    for key in ('ProblemID', 'PID', 'State'):
+        if not problem_simple.get(key):
+            return False
+    return True
+
+
+# Called by the workers of the ingest queue for each received notification.
+# When the integrations fail the notification is parked in the retry queue.
+def process_notification(problem_simple):
+    try:
+        call_integration(problem_simple['PID'], problem_simple['State'])
+    except Exception as e:
+        park_notification(problem_simple, e)
+
+
+def park_notification(problem_simple, e):
+    logging.error("There was an error calling the integrations for problem %s: %s", problem_simple['ProblemID'], e,
+                  extra={'problem': problem_simple['ProblemID'], 'pid': problem_simple['PID']})
+    logging.debug("Traceback of the error", exc_info=True)
+    RETRY_QUEUE.park('notification', problem_simple, str(e))
+
+
+def retry_notification(problem_simple):
+    call_integration(problem_simple['PID'], problem_simple['State'])
+
+
+# Queue of the received notifications processed by the ingest workers
+INGEST_QUEUE = TenantProxy(TENANTS, 'ingest_queue')
+
+
 # Will return the uptime in seconds, minutes, hours and days
 def get_uptime():
     return str(timedelta(seconds=timeit.default_timer() - start_time))
 
 
 def break_dic_in_rows(values):
-    row = ''
-    for key, value in values.items():
-        row += key + ':' + str(value) + '<br>'
-    return row
+    return ''.join([key + ':' + str(value) + '<br>' for key, value in values.items()])
 
 
 def break_list_in_rows(values):
-    row = ''
-    for value in values:
-        row += str(value) + '<br>'
-    return row
+    return ''.join([str(value) + '<br>' for value in values])
 
 
 def get_timestamp_to_date(millisec):
@@ -165,7 +451,7 @@ def get_timestamp_to_date(millisec):
 def get_proper_value(key, value):
     
     if 'id' == key:
-        return '<a target="_blank" href="{0}{1}{2}">open in Dynatrace</a>'.format(TENANT_HOST, UI_PROBLEM_DETAIL_BY_ID, value)
+        return '<a target="_blank" href="{0}{1}{2}">open in Dynatrace</a>'.format(TENANTS.current().host, UI_PROBLEM_DETAIL_BY_ID, value)
     
     if 'time' in key.lower() and isinstance(value, int):
         return get_timestamp_to_date(value)
@@ -192,101 +478,257 @@ def get_proper_value(key, value):
         return str(value)
 
 
-# Returns an HTML table from a dictionary
+# Returns the header and the row of an HTML table from a dictionary
+def get_table_row(item):
+    th = ''.join(['<th>' + key + '</th>' for key in item.keys()])
+    td = ''.join(['<td>' + get_proper_value(key, value) + '</td>' for key, value in item.items()])
+    return '<tr>' + th + '</tr>', '<tr>' + td + '</tr>'
+
+
+def get_table_from_rows(rows):
+    return '<div style="overflow-x:auto;"><table>' + ''.join(rows) + '</table></div>'
+
+
+# Returns an HTML table from a list of dictionaries, the header is taken from the first one
 def get_table_from_list(items):
-    rows = ''
-    i = 0
+    rows = []
     for item in items:
-        i = i + 1
-        td = '<tr>'
-        if i == 1:
-            th = '<tr>'
-        for key, value in item.items():
-            td += '<td>' + get_proper_value(key, value) + '</td>'
-            if i == 1:
-                th += '<th>' + key + '</th>'
-            
-        td += '</tr>'
-        if i == 1:
-            th += '</tr>'
-            rows += th + td
-        else:
-            rows += td
-    return '<div style="overflow-x:auto;"><table>' + rows + '</table></div>'
-    
+        th, td = get_table_row(item)
+        if not rows:
+            rows.append(th)
+        rows.append(td)
+    return get_table_from_rows(rows)
+
+
+# Rendered rows of the sent problems table by problem number. A row is rendered
+# again when the problem is sent again (call_integration invalidates it).
+ROW_CACHE = TenantProxy(TENANTS, 'row_cache')
+
+
+def get_sent_problem_row(display_name, updated):
+    cached = ROW_CACHE.get(display_name, lambda row: row[0] == updated)
+    if cached is None:
+        th, td = get_table_row(get_sent_problem_details(display_name))
+        cached = (updated, th, td)
+        ROW_CACHE.put(display_name, cached)
+    return cached[1], cached[2]
+
 
-def get_table():
-    # TODO: Get only the table when a problem comes. save it in memory and actualize it?
-    if len(PROBLEMS_SENT.values()) == 0:
+# Returns a page of the sent problems table, the newest problems first
+def get_table(page=1, newest_first=True):
+    total = STORE.count_problems()
+    if total == 0:
         return 'No problems polled nor received.'
     
+    pages = (total + DASHBOARD_PAGE_SIZE - 1) // DASHBOARD_PAGE_SIZE
+    page = min(max(page, 1), pages)
+    
     # Populate the table
     table = ''
     try:
-        table = get_table_from_list(PROBLEMS_SENT.values())
+        rows = []
+        for display_name, updated in STORE.load_index_page((page - 1) * DASHBOARD_PAGE_SIZE, DASHBOARD_PAGE_SIZE,
+                                                           newest_first):
+            th, td = get_sent_problem_row(display_name, updated)
+            if not rows:
+                rows.append(th)
+            rows.append(td)
+        table = get_page_buttons(page, pages, newest_first) + get_table_from_rows(rows)
     except Exception as e:
-        logging.error("There was an error generating the html Table:" + str(e))
-        logging.error(traceback.format_exc())
+        logging.error("There was an error generating the html Table: %s", e, exc_info=True)
         
     return table
 
 
-def get_buttons_from_relativetimes():
-    buttons = ''
-    for t in RELATIVETIMES:
-        buttons += "<button onclick=\"window.location.href='?relativeTime={0}'\">{0}</button>&nbsp;".format(t)
-    return buttons
+def get_page_buttons(page, pages, newest_first):
+    order = 'newest' if newest_first else 'oldest'
+    buttons = ["Page {0} of {1}&nbsp;".format(page, pages)]
+    for label, target in (('first', 1), ('previous', page - 1), ('next', page + 1), ('last', pages)):
+        if 1 <= target <= pages and target != page:
+            buttons.append("<button onclick=\"window.location.href='?page={0}&order={1}'\">{2}</button>&nbsp;".format(
+                target, order, label))
+    for label in ('newest', 'oldest'):
+        if label != order:
+            buttons.append("<button onclick=\"window.location.href='?page=1&order={0}'\">{0} first</button>".format(
+                label))
+    return ''.join(buttons) + '<br>'
 
 
-# Flask listener for GET Method
-# with public access
-@app.route('/', methods=['GET'])
-def handle_get():
-    time_option = request.args.get('relativeTime')
-    
-    flash(Markup("<br>Python Flask Webhook endpoint: " + TENANT_HOST + "</br>"))
-    flash(Markup("<br>Flask Web Microservice running on: https://{0}:{1}".format(WEBHOOK_INTERFACE, WEBHOOK_PORT)))
-    flash(Markup("<br>Received notifications: {0}".format(prob_count)))
-    flash(Markup("<br>Path: {0}".format(os.getcwd())))
-    flash(Markup("<br>Host: {0}".format(socket.gethostname())))
-    flash(Markup("<br>User: {0}".format(WEBHOOK_USERNAME)))
-    flash(Markup("<br>PID: {0}".format(os.getpid())))
-    flash(Markup("<br>Uptime: {0}".format(get_uptime())))
+def get_buttons_from_relativetimes():
+    return ''.join(["<button onclick=\"window.location.href='?relativeTime={0}'\">{0}</button>&nbsp;".format(t)
+                    for t in RELATIVETIMES])
+
+
+# HTML lines of the dashboard (the GET page of the webserver)
+def get_dashboard_lines(time_option=None, page=1, newest_first=True):
+    lines = []
+    lines.append("<br>Python Flask Webhook endpoint: " + TENANTS.current().host + "</br>")
+    if len(TENANTS) > 1:
+        lines.append("<br>Tenant: {0} (tenants: {1})".format(TENANTS.current().name, get_tenant_links_as_html()))
+    lines.append("<br>Flask Web Microservice running on: https://{0}:{1}".format(WEBHOOK_INTERFACE, WEBHOOK_PORT))
+    lines.append("<br>Received notifications: {0}".format(STORE.get_counter(RECEIVED_COUNTER)))
+    lines.append("<br>Path: {0}".format(os.getcwd()))
+    lines.append("<br>Host: {0}".format(socket.gethostname()))
+    lines.append("<br>User: {0}".format(WEBHOOK_USERNAME))
+    lines.append("<br>PID: {0}".format(os.getpid()))
+    lines.append("<br>Uptime: {0}".format(get_uptime()))
+    lines.append("<br>Ingest queue: {0}".format(get_queue_stats_as_string(INGEST_QUEUE)))
+    if POLL_TASK.is_started():
+        lines.append("<br>Scheduled poll: {0}".format(get_poll_stats_as_string()))
+    lines.append("<br>Duplicate notifications: {0}".format(get_dedupe_stats_as_string()))
+    lines.append("<br>Sent problems in memory: {0}".format(get_sent_stats_as_string()))
+    lines.append("<br>Problem details cache: {0}".format(get_cache_stats_as_string(PROBLEM_CACHE)))
+    if SMS_NOTIFICATION:
+        lines.append("<br>SMS: {0}".format(get_sms_stats_as_string()))
+    lines.append("<br>Problem comments: {0}".format(get_outbox_stats_as_string()))
+    if INCIDENT_COPROCESS:
+        lines.append("<br>Incident Software workers: {0}".format(get_incident_pool_stats_as_string()))
+    lines.append("<br>Archive: {0}".format(get_archive_stats_as_string()))
+    lines.append("<br>Log queue: {0}".format(get_log_stats_as_string()))
+    lines.append("<br>Outbound targets:<br>{0}".format(get_resilience_stats_as_html()))
+    lines.append("<br>Dynatrace API latency:<br>{0}".format(get_api_stats_as_html()))
+    lines.append("<br>Dynatrace API rate limit: {0}".format(get_governor_stats_as_html()))
+    lines.append("<br>Metrics (Prometheus format): <a href=\"/metrics\">/metrics</a>")
     # TODO JQuery efect
     
-    flash(Markup("<br><button onclick=\"showHideById('usage')\">toggle usage</button>"))
-    flash(Markup("<div id=\"usage\" class=\"usage\">"))
-    flash(Markup("{0}".format(get_usage_as_html())))
-    flash(Markup("</div>"))
-    flash(Markup("<br><br>Poll the problems via API for the last:"))
-    flash(Markup(get_buttons_from_relativetimes()))
+    lines.append("<br><button onclick=\"showHideById('usage')\">toggle usage</button>")
+    lines.append("<div id=\"usage\" class=\"usage\">")
+    lines.append("{0}".format(get_usage_as_html()))
+    lines.append("</div>")
+    lines.append("<br><br>Poll the problems via API for the last:")
+    lines.append(get_buttons_from_relativetimes())
         
     if time_option:
         data = get_problemsfeed_by_time(time_option)
-        flash(Markup("<br><button onclick=\"showHideById('table_poll')\">toggle poll table</button>"))
-        flash(Markup("<div id=\"table_poll\">"))
-        flash(Markup("<br>There were {0} problems found during the selected timeframe '{1}'".format(
-                len(data['result']['problems']), time_option)))
-        flash(Markup("<br>Dynatrace has monitored the following entities in the last '{0}':".format(time_option)))
-        flash(Markup("<br>APPLICATION:\t {:6}".format(data['result']['monitored']['APPLICATION'])))
-        flash(Markup("<br>SERVICE:\t {:6}".format(data['result']['monitored']['SERVICE'])))
-        flash(Markup("<br>INFRASTRUCTURE:\t {:6}".format(data['result']['monitored']['INFRASTRUCTURE'])))
-        flash(Markup(get_table_from_list(data['result']['problems'])))
-        flash(Markup("</div>"))
+        lines.append("<br><button onclick=\"showHideById('table_poll')\">toggle poll table</button>")
+        lines.append("<div id=\"table_poll\">")
+        lines.append("<br>There were {0} problems found during the selected timeframe '{1}'".format(
+                len(data['result']['problems']), time_option))
+        lines.append("<br>Dynatrace has monitored the following entities in the last '{0}':".format(time_option))
+        lines.append("<br>APPLICATION:\t {:6}".format(data['result']['monitored']['APPLICATION']))
+        lines.append("<br>SERVICE:\t {:6}".format(data['result']['monitored']['SERVICE']))
+        lines.append("<br>INFRASTRUCTURE:\t {:6}".format(data['result']['monitored']['INFRASTRUCTURE']))
+        lines.append(get_table_from_list(data['result']['problems']))
+        lines.append("</div>")
         
-    flash(Markup("<br><br><button onclick=\"showHideById('table_saved')\">toggle sent table</button>"))
-    flash(Markup("<div id=\"table_saved\">"))
-    flash(Markup("Successfully sent problems (saved in {0}\{1}):".format(os.getcwd(), DIR_SENT)))
-    flash(Markup("<br>" + get_table()))
-    flash(Markup("</div>"))
-    return render_template('index.html')
+    lines.append("<br><br><button onclick=\"showHideById('table_saved')\">toggle sent table</button>")
+    lines.append("<div id=\"table_saved\">")
+    lines.append("Successfully sent problems (saved in {0}):".format(os.path.abspath(STORE.filename)))
+    lines.append("<br>" + get_table(page, newest_first))
+    lines.append("</div>")
+    return lines
+
+
+
+def get_queue_stats_as_string(work_queue):
+    stats = work_queue.stats()
+    return "depth {0}/{1}, workers {2}, processed {3}, failed {4}, rejected {5}, " \
+           "wait avg {6:.3f}s max {7:.3f}s, processing avg {8:.3f}s max {9:.3f}s".format(
+               stats['depth'], stats['max_size'], stats['workers'], stats['processed'], stats['failed'],
+               stats['rejected'], stats['wait_avg'], stats['wait_max'], stats['process_avg'], stats['process_max'])
+
+
+def get_poll_stats_as_string():
+    stats = POLL_TASK.stats()
+    return "every {0}s, runs {1}, failed {2}, skipped {3}, last duration {4:.1f}s{5}".format(
+        stats['interval'], stats['runs'], stats['failed'], stats['skipped'], stats['last_duration'],
+        ' (running)' if stats['running'] else '')
+
+
+def get_dedupe_stats_as_string():
+    stats = DEDUPE_INDEX.stats()
+    return "suppressed {0}, remembered {1} within {2}s".format(stats['suppressed'], stats['size'], stats['window'])
+
+
+def get_sent_stats_as_string():
+    stats = PROBLEMS_SENT.stats()
+    return "tracked {0} (open {1}, closed {2}), evicted {3}, memory {4:.1f} KB ({5:.0f} bytes per problem)".format(
+        stats['tracked'], stats['open'], stats['closed'], stats['evicted'], stats['memory'] / 1024.0,
+        stats['memory_per_problem'])
+
+
+def get_cache_stats_as_string(cache):
+    stats = cache.stats()
+    return "size {0}/{1}, hits {2}, misses {3} (hit ratio {4:.0%}), evictions {5}, expirations {6}, " \
+           "invalidations {7}".format(stats['size'], stats['max_entries'], stats['hits'], stats['misses'],
+                                      stats['hit_ratio'], stats['evictions'], stats['expirations'],
+                                      stats['invalidations'])
+
+
+def get_sms_stats_as_string():
+    stats = SMS_DISPATCHER.stats()
+    return "queued {0}, problems notified {1}, duplicates skipped {2}, sent {3} ({4} digests), failed {5}".format(
+        stats['queued'], stats['notified'], stats['deduplicated'], stats['sent'], stats['digests'], stats['failed'])
+
+
+def get_outbox_stats_as_string():
+    stats = COMMENT_OUTBOX.stats()
+    return "pending {0}, posting {1}, sent {2} in {3} posts, retries {4}, failed {5}, outbox full {6}".format(
+        stats['pending'], stats['posting'], stats['sent'], stats['posts'], stats['retries'], stats['failed'],
+        stats['overflowed'])
+
+
+def get_incident_pool_stats_as_string():
+    stats = INCIDENT_POOL.stats()
+    return "{0} of {1} running, calls {2}, restarted after exit {3}, timeout {4}, lost {5}, unhealthy {6}".format(
+        stats['alive'], stats['workers'], stats['calls'], stats['restarts'], stats['timeouts'], stats['lost'],
+        stats['unhealthy'])
+
+
+def get_archive_stats_as_string():
+    stats = ARCHIVE.stats()
+    return "{0} segments ({1:.1f} MB) in {2}, archived {3}, expired segments deleted {4}".format(
+        stats['segments'], stats['size'] / 1048576.0, os.path.abspath(ARCHIVE.directory), stats['archived'],
+        stats['pruned'])
+
+
+def get_log_stats_as_string():
+    stats = LOG_PIPELINE.stats()
+    return "{0} records waiting, {1} dropped (queue of {2})".format(stats['queued'], stats['dropped'], LOG_QUEUE_SIZE)
+
+
+def get_resilience_stats_as_html():
+    lines = []
+    for target in (DT_TARGET, TWILIO_TARGET, INCIDENT_TARGET):
+        stats = target.stats()
+        lines.append("&nbsp;&nbsp;{0}: circuit {1}, calls {2}, retries {3}, failed {4}, rejected {5}".format(
+            target.name, stats['state'], stats['calls'], stats['retries'], stats['failed'], stats['rejected']))
+    stats = RETRY_QUEUE.stats()
+    lines.append("&nbsp;&nbsp;retry queue: pending {0}, parked {1}, done {2}, dropped {3}".format(
+        stats['pending'], stats['parked'], stats['done'], stats['dropped']))
+    return '<br>'.join(lines)
+
+
+def get_api_stats_as_html():
+    lines = []
+    for name, stats in sorted(DT_CLIENT.stats().items()):
+        lines.append("&nbsp;&nbsp;{0}: calls {1}, errors {2}, avg {3:.3f}s, max {4:.3f}s".format(
+            name, stats['count'], stats['errors'], stats['avg'], stats['max']))
+    return '<br>'.join(lines) if lines else '&nbsp;&nbsp;no calls made yet'
+
+
+def get_governor_stats_as_html():
+    if not API_GOVERNOR.rate:
+        return "none"
+    stats = API_GOVERNOR.stats()
+    lines = ["{0:g} requests/min (burst {1}), throttled by Dynatrace {2} times, paused {3:.1f}s".format(
+        API_GOVERNOR.rate * 60, API_GOVERNOR.burst, stats['throttled'], stats['paused'])]
+    for lane in API_LANES:
+        lane_stats = stats['lanes'][lane]
+        lines.append("&nbsp;&nbsp;{0}: requests {1}, waited {2}, waiting {3}, avg wait {4:.3f}s, max {5:.3f}s".format(
+            lane, lane_stats['acquired'], lane_stats['waited'], lane_stats['waiting'], lane_stats['avg_wait'],
+            lane_stats['max_wait']))
+    return '<br>'.join(lines)
+
+
+# Links to the dashboards of the tenants (the default one is served in /)
+def get_tenant_links_as_html():
+    return ', '.join(['<a href="{0}">{1}</a>'.format('/' if tenant is TENANTS.default else '/tenant/' + tenant.name,
+                                                     tenant.name) for tenant in TENANTS])
 
 
 def get_usage_as_html():
-    str_with_breaks = ''
-    for line in get_usage_as_string().splitlines():
-        str_with_breaks += line + '</br>'
-    return str_with_breaks
+    return ''.join([line + '</br>' for line in get_usage_as_string().splitlines()])
 
 
 # For handling Tenants with an invalid SSL Certificate just set it to false.
@@ -302,38 +744,84 @@ def handle_response_status(msg, response):
         raise Exception(err_msg)
 
 
-def getAuthenticationHeader():
-    return {"Authorization": "Api-Token " + API_TOKEN}
+# Rate limit of all the calls to the Dynatrace API of the tenant (shared by its callers)
+API_GOVERNOR = TenantProxy(TENANTS, 'api_governor')
+
+# Client for all the calls to the Dynatrace API of the tenant (pooled keep-alive connections)
+DT_CLIENT = TenantProxy(TENANTS, 'dt_client')
 
 
 def get_problemsfeed_by_time(time_option):
     msg = "fetching prob_count for '" + time_option + "' - " + API_ENDPOINT_PROBLEM_FEED
     logging.info(msg)
-    response = requests.get(TENANT_HOST + API_ENDPOINT_PROBLEM_FEED + "?relativeTime=" + time_option,
-                            headers=getAuthenticationHeader(), verify=verifyRequest())
+    response = DT_CLIENT.get(API_ENDPOINT_PROBLEM_FEED, params={'relativeTime': time_option}, lane='feed')
 
     handle_response_status(msg, response)
     data = json.loads(response.text)
-    logging.debug('Reponse content: ' + str(response.content))
+    logging.debug('Reponse content: %s', response.content)
     return data
 
 
+# Keys of the problem details needed by the integrations
+PROBLEM_DETAILS_KEYS = ('id', 'displayName', 'status', 'severityLevel', 'impactLevel', 'tagsOfAffectedEntities')
+
+# Cache of the problem details by PID
+PROBLEM_CACHE = TenantProxy(TENANTS, 'problem_cache')
+
+
+# Notifications have the State OPEN or RESOLVED, the problem details the status OPEN or CLOSED
+def is_same_state(problem_details, state):
+    return (state == 'OPEN') == (problem_details['status'] == 'OPEN')
+
+
+# Returns the details of the problem from the cache. They are fetched again
+# if they are not cached or the state of the problem has changed.
+def get_problem_details(problem_id, state=None):
+    if state is None:
+        problem_details = PROBLEM_CACHE.get(problem_id)
+    else:
+        problem_details = PROBLEM_CACHE.get(problem_id, lambda cached: is_same_state(cached, state))
+    if problem_details is not None:
+        logging.info("Problem ID %s taken from the cache", problem_id, extra={'pid': problem_id})
+        return problem_details
+    
+    problem_details = get_problem_by_id(problem_id)
+    PROBLEM_CACHE.put(problem_id, problem_details)
+    return problem_details
+
+
+# The problems of the feed can be used as details if they contain all the keys the integrations need
+def is_sufficient_problem(problem):
+    for key in PROBLEM_DETAILS_KEYS:
+        if key not in problem:
+            return False
+    return 'rankedImpacts' in problem or 'rankedEvents' in problem
+
+
 def get_problem_by_id(problemid):
-    msg = "fetching problem id " + str(problemid)
-    logging.info(msg)
-    response = requests.get(TENANT_HOST + API_ENDPOINT_PROBLEM_DETAILS + problemid, headers=getAuthenticationHeader(),
-                            verify=verifyRequest())
-    handle_response_status(msg, response)
-    data = json.loads(response.text)
-    logging.info("Problem ID " + problemid + " fetched")
+    started_at = timeit.default_timer()
+    with GET_PROBLEM_TIME.time():
+        response = DT_CLIENT.get(API_ENDPOINT_PROBLEM_DETAILS, problemid, lane='details')
+        handle_response_status("fetching problem id " + str(problemid), response)
+        data = json.loads(response.text)
+    logging.info("Problem ID %s fetched", problemid,
+                 extra={'pid': problemid, 'duration': round(timeit.default_timer() - started_at, 4)})
     return data['result']
 
 
 def is_new_problem(problem):
-    if problem['displayName'] in PROBLEMS_SENT:
-        if PROBLEMS_SENT.get(problem['displayName'])['status'] == problem['status']:
+    record = get_sent_problem(problem['displayName'])
+    if record is not None and record.status != problem['status']:
+        # Another worker process may have sent it meanwhile, the database is up to date
+        row = STORE.get_index_row(problem['displayName'])
+        if row is not None:
+            record = ProblemRecord(*row)
+            PROBLEMS_SENT.put(record)
+    if record is not None:
+        if record.status == problem['status']:
             logging.info(
-                "Problem {0} has already been submitted to the Incident Software. To do it again delete the file {0}.json in the directory {1}".format(problem['displayName'], DIR_SENT))
+                "Problem %s has already been submitted to the Incident Software. To do it again delete it from the table problems_sent of %s", problem['displayName'], STORE.filename,
+                extra={'problem': problem['displayName']})
             return False
         else:
             return True
@@ -376,7 +864,7 @@ def get_program_argument(problem_details):
 
 def post_incident_result_in_problem_comments(problem, return_code, error):
     problemNr = problem['displayName']
-    logging.info('Problem {0} will be commented in Dynatrace'.format(problemNr))
+    logging.info('Problem %s will be commented in Dynatrace', problemNr, extra={'problem': problemNr})
     data = {}
     if error:
         data['comment'] = "The problem {0} could not been sent to the Incident Software. Return Codes[{1}]".format(problemNr, return_code)
@@ -386,35 +874,44 @@ def post_incident_result_in_problem_comments(problem, return_code, error):
     data['user'] = WEBHOOK_USERNAME
     data['context'] = 'Incident Software Custom Integration'
     
-    
-    r = post_in_comments(problem, data);
-
-    if r.status_code == 200:
-        logging.info('Problem {0} was commented successfully in Dynatrace'.format(problemNr))
-        logging.debug('Content:{1}'.format(problemNr, data))
-    else:
-        logging.error(
-            'Problem {0} could not be commented in Dynatrace. Reason {1}-{2}. Content:{3}'.format(problemNr,
-                                                                                                          r.reason,
-                                                                                                          r.status_code,
-                                                                                                          data))
+    # The comment is posted asynchronously, together with the other comments of the problem
+    COMMENT_OUTBOX.add(problem, data)
     return
 
 def post_in_comments(problem, data):
-    # Define header
-    headers = {'content-type': 'application/json', "Authorization": "Api-Token " + API_TOKEN}
-    # Make POST Request
-    r = requests.post(TENANT_HOST + API_ENDPOINT_PROBLEM_DETAILS + problem['id'] + "/comments", json=data,
-                      headers=headers, verify=verifyRequest())
+    # Make POST Request, the content-type is set by the json parameter
+    with COMMENT_POST_TIME.time():
+        r = DT_CLIENT.post(API_ENDPOINT_PROBLEM_DETAILS, problem['id'] + "/comments", json=data, lane='comments')
     # Return response
     return r
 
 
+# Comments that could not be posted are parked in the retry queue
+def park_comment(problem, data, reason):
+    RETRY_QUEUE.park('comment', {'problem': {'id': problem['id'], 'displayName': problem['displayName']},
+                                 'data': data}, reason)
+
+
+def retry_comment(payload):
+    r = post_in_comments(payload['problem'], payload['data'])
+    if r.status_code >= 300:
+        raise Exception('{0}-{1}'.format(r.reason, r.status_code))
+
+
+# Comments waiting to be posted in the problems
+COMMENT_OUTBOX = TenantProxy(TENANTS, 'comment_outbox')
+
+
 # In this method are the integrations defined and called
-def call_integration(problem_id):
+# The state of the notification or the status of the polled problem (if known) is used to refresh cached details.
+# When the details are already known (e.g. from the problem feed) they are not fetched.
+def call_integration(problem_id, state=None, problem_details=None):
     
     # Fetch all the details of the Problem
-    problem_details = get_problem_by_id(problem_id)
+    if problem_details is None:
+        problem_details = get_problem_details(problem_id, state)
+    else:
+        PROBLEM_CACHE.put(problem_id, problem_details)
         
     # Notify the incident software and comment the result in Dynatrace
     if INCIDENT_NOTIFICATION: 
@@ -426,7 +923,8 @@ def call_integration(problem_id):
     
     # Problems will be sent two times, when open and closed.
     # Update the dictionary e.g. when a Problem is closed. The problemNr is the key of the dictionary
-    PROBLEMS_SENT[problem_details["displayName"]] = problem_details
+    PROBLEMS_SENT.put(ProblemRecord.from_details(problem_details))
+    ROW_CACHE.invalidate(problem_details["displayName"])
     
     # Persist the sent notifications
     persist_problem(problem_details)
@@ -434,169 +932,782 @@ def call_integration(problem_id):
 
 
 def call_sms_integration(problem_details):
-    
-    # SMS Client initialized with the Twilio Account (SID and Auth-Token)
-    sms_client = Client(TWILIO_ACCOUNT, TWILIO_TOKEN)
-    
-    level = problem_details["impactLevel"]
-    nr =  problem_details["displayName"]
-    pid = problem_details["id"]
-    status = problem_details["status"]
-    
-    # change the "from_" number to your Twilio number and the "to" number
-    # to the phone number you signed up for Twilio with, or upgrade your
-    # account to send SMS to any phone number
-    body = "Dynatrace notification - {0} problem ({1}) {5}. Open in Dynatrace:{2}{3}{4}".format(level.lower(), nr, TENANT_HOST, UI_PROBLEM_DETAIL_BY_ID, pid, status.lower())
-    sms_client.messages.create(to=TO_NUMBER, from_=TWILIO_NUMBER, body=body)
-     
-    TO_NUMBER
-    # Post SMS result in the comments
-    data = {}
-    data['comment'] = "Mobile number has been notified: {0}".format(anonymize_numer(TO_NUMBER))
-    data['user'] = WEBHOOK_USERNAME
-    data['context'] = 'Twilio Custom Integration'
-    r = post_in_comments(problem_details, data)
-    # Log to the console
-    logging.info('{0}: {1} sent from {2}'.format(data['context'] , data['comment'], TWILIO_NUMBER))
+    # The SMS is queued and sent by the dispatcher
+    SMS_DISPATCHER.notify(problem_details)
     return
 
+
+def get_sms_body(problems):
+    if len(problems) == 1:
+        problem_details = problems[0]
+        level = problem_details["impactLevel"]
+        nr =  problem_details["displayName"]
+        pid = problem_details["id"]
+        status = problem_details["status"]
+        return "Dynatrace notification - {0} problem ({1}) {5}. Open in Dynatrace:{2}{3}{4}".format(level.lower(), nr, TENANTS.current().host, UI_PROBLEM_DETAIL_BY_ID, pid, status.lower())
+    
+    # Digest of several problems
+    problem_list = ', '.join(["{0} ({1}) {2}".format(p["displayName"], p["impactLevel"].lower(), p["status"].lower())
+                              for p in problems])
+    return "Dynatrace notification - {0} problems: {1}. Open in Dynatrace:{2}/#problems".format(
+        len(problems), problem_list, TENANTS.current().host)
+
+
+# Post SMS result in the comments of each problem
+def post_sms_result_in_problem_comments(problems, recipients):
+    numbers = ', '.join([anonymize_numer(number) for number in recipients])
+    for problem_details in problems:
+        data = {}
+        data['comment'] = "Mobile number has been notified: {0}".format(numbers)
+        data['user'] = WEBHOOK_USERNAME
+        data['context'] = 'Twilio Custom Integration'
+        COMMENT_OUTBOX.add(problem_details, data)
+        # Log to the console
+        logging.info('%s: %s sent from %s', data['context'], data['comment'], TWILIO_NUMBER,
+                     extra={'problem': problem_details['displayName']})
+
+
+# SMS that could not be sent are parked in the retry queue
+def park_sms(problems, to, error):
+    fields = ('id', 'displayName', 'status', 'impactLevel')
+    RETRY_QUEUE.park('sms', {'problems': [dict((key, p[key]) for key in fields) for p in problems], 'to': to},
+                     str(error))
+
+
+def retry_sms(payload):
+    SMS_DISPATCHER.send(payload['to'], get_sms_body(payload['problems']))
+    post_sms_result_in_problem_comments(payload['problems'], [payload['to']])
+
+
+def get_sms_transport():
+    if SMS_TRANSPORT == 'http':
+        return HttpTransport(TWILIO_ACCOUNT, TWILIO_TOKEN, TWILIO_NUMBER, SMS_API_URL, SMS_TIMEOUT)
+    return TwilioTransport(TWILIO_ACCOUNT, TWILIO_TOKEN, TWILIO_NUMBER, SMS_TIMEOUT)
+
+
+# The numbers to notify can be one number or a list
+if isinstance(TO_NUMBER, list):
+    SMS_RECIPIENTS = TO_NUMBER
+else:
+    SMS_RECIPIENTS = [TO_NUMBER]
+
+# One reusable transport for all the SMS, used by the long-lived dispatcher of each tenant
+SMS_TRANSPORT_CLIENT = get_sms_transport()
+SMS_DISPATCHER = TenantProxy(TENANTS, 'sms_dispatcher')
+
 def anonymize_numer(number):
     return str(number[0:3] + '*****' + number[-4:])
 
+# Check the OS of the program to call (Windows or Linux)
+if os.name == 'nt':
+    EXECUTABLE = EXEC_WIN
+    WORKER = WORKER_WIN
+else:
+    EXECUTABLE = EXEC_UNIX
+    WORKER = WORKER_UNIX
+
+# Co-process workers of the Incident Software (started with the first call) instead of a process per call
+INCIDENT_COPROCESS = INCIDENT_MODE == 'coprocess' and bool(WORKER)
+INCIDENT_POOL = TenantProxy(TENANTS, 'incident_pool')
+
+# Pool calling the Incident Software for all the problems of the tenant
+INCIDENT_EXECUTOR = TenantProxy(TENANTS, 'incident_executor')
+
+# Restarts the co-process workers that do not answer a ping
+INCIDENT_HEALTH_TASK = TenantProxy(TENANTS, 'incident_health_task')
+
+
 def call_incident_software(problem_details):
     
     problem_nr = problem_details['displayName']
-    # Check the OS of the program to call (Windows or Linux)
-    if os.name == 'nt':
-        EXECUTABLE = EXEC_WIN
-    else:
-        EXECUTABLE = EXEC_UNIX
-
     argument_list = get_program_argument(problem_details)
     
+    # The calls are made in parallel, the return codes come in the order of the arguments
+    started_at = timeit.default_timer()
     return_codes = []
-    for argument in argument_list:
-        return_code = (subprocess.call(EXECUTABLE + ' ' + argument, shell=True))
-        logging.info('Incident Software call for [{0}] RC[{1}] Executable:[{2}] Arguments:{3}'.format(str(problem_nr), return_code, EXECUTABLE, argument))
+    for arguments, return_code in INCIDENT_EXECUTOR.call_all(argument_list):
+        logging.debug('Incident Software call for [%s] RC[%s] Executable:[%s] Arguments:%s', problem_nr, return_code,
+                      EXECUTABLE, arguments)
         return_codes.append(return_code)
+    fields = {'problem': problem_nr, 'return_codes': return_codes,
+              'duration': round(timeit.default_timer() - started_at, 4)}
 
-    # Check all the return codes
-    for r in return_codes:
-        r += r
-    # If the sum is bigger than zero, a problem occurred when calling the Incident software.
-    if r == 0:
-        logging.info('All calls to the Incident Software for [{0}] OK, Return Codes{1}'.format(problem_nr, return_codes))
+    # If any return code is not zero, a problem occurred when calling the Incident software.
+    if not any(return_codes):
+        logging.info('All calls to the Incident Software for [%s] OK, Return Codes%s', problem_nr, return_codes,
+                     extra=fields)
         post_incident_result_in_problem_comments(problem_details, return_codes, False)
         
     else:
-        logging.error('There was a problem calling the Incident Software [{0}], Return Codes{1}'.format(problem_nr, return_codes))
+        logging.error('There was a problem calling the Incident Software [%s], Return Codes%s', problem_nr, return_codes,
+                      extra=fields)
         post_incident_result_in_problem_comments(problem_details, return_codes, True)
     return
 
 
-# This will save the json notification in a directory
+# This will save the json notification in the database
 def save_request(data):
-    if not os.path.exists(DIR_RECEIVED):
-        os.makedirs(DIR_RECEIVED)
-    problemnr = data['ProblemID']
-    state = data['State']
-    filename = problemnr + '-' + state + '.json'
-    with open(DIR_RECEIVED + '/' + filename, 'w') as f:
-        json.dump(data, f, ensure_ascii=False)
+    with SAVE_REQUEST_TIME.time():
+        STORE.add_notification(data)
     return
 
 
+# Saves the notification unless the same one (PID and State) was saved within the dedupe window.
+# The check and the insert are atomic, so only one worker process calls the integrations.
+# Returns the id of the saved notification, None if it is repeated.
+def save_request_once(data):
+    with SAVE_REQUEST_TIME.time():
+        return STORE.add_notification_once(data, now_millis() - DEDUPE_WINDOW * 1000)
+
+
 # Poll the errors
 def poll_problems(time_option):
     logging.info("----------------------------------------------")
-    logging.info("Polling problems for {0}{1} with Key'{2}' and relativeTime '{3}'".format(TENANT_HOST,
-                                                                                             API_ENDPOINT_PROBLEM_FEED,
-                                                                                             API_TOKEN, time_option))
+    logging.info("Polling problems for %s%s with relativeTime '%s'", TENANTS.current().host, API_ENDPOINT_PROBLEM_FEED,
+                 time_option)
     try:
         data = get_problemsfeed_by_time(time_option)
         # Print the amount of errors and monitored entities.
-        logging.info("There were {0} problems found during the selected timeframe '{1}'".format(
-            len(data['result']['problems']), time_option))
-        logging.info("Dynatrace has monitored the following entities in the last '{0}':".format(time_option))
-        logging.info("APPLICATION:\t {:6}".format(data['result']['monitored']['APPLICATION']))
-        logging.info("SERVICE:\t {:6}".format(data['result']['monitored']['SERVICE']))
-        logging.info("INFRASTRUCTURE:\t {:6}".format(data['result']['monitored']['INFRASTRUCTURE']))
+        logging.info("There were %s problems found during the selected timeframe '%s'",
+                     len(data['result']['problems']), time_option)
+        logging.info("Dynatrace has monitored the following entities in the last '%s':", time_option)
+        logging.info("APPLICATION:\t %6s", data['result']['monitored']['APPLICATION'])
+        logging.info("SERVICE:\t %6s", data['result']['monitored']['SERVICE'])
+        logging.info("INFRASTRUCTURE:\t %6s", data['result']['monitored']['INFRASTRUCTURE'])
 
         if (data and data['result']['problems']):
             for problem_details in data['result']['problems']:
-                if is_new_problem(problem_details):
-                    call_integration(problem_details['id'])
+                if not renew_lease():
+                    break
+                process_polled_problem_or_park(problem_details)
+    except Exception as e:
+        logging.error("There was an error polling the problems", exc_info=True)
+    return
+
+
+def process_polled_problem(problem_details):
+    if is_new_problem(problem_details):
+        if POLL_REUSE_FEED and is_sufficient_problem(problem_details):
+            call_integration(problem_details['id'], problem_details=problem_details)
+        else:
+            # The status of the feed refreshes the cached details when the problem changed meanwhile
+            call_integration(problem_details['id'], problem_details['status'])
+
+
+# When the integrations fail for a polled problem it is parked in the retry queue and the poll goes on,
+# so the problem is not lost when the cursor of the incremental poll moves past it
+def process_polled_problem_or_park(problem_details):
+    try:
+        process_polled_problem(problem_details)
     except Exception as e:
-        logging.error("There was an error polling the problems")
-        logging.error(traceback.format_exc())
+        logging.error("There was an error calling the integrations for problem %s", problem_details['displayName'],
+                      exc_info=True, extra={'problem': problem_details['displayName']})
+        RETRY_QUEUE.park('polled_problem', problem_details, str(e))
+
+
+def retry_polled_problem(problem_details):
+    process_polled_problem(problem_details)
+
+
+# Poll only the problems since the last incremental poll. The first poll
+# (without a cursor in the database) takes the relativeTime time_option.
+# The answer of the feed is processed as a stream, problem by problem.
+def poll_new_problems(time_option):
+    logging.info("----------------------------------------------")
+    cursor = STORE.get_value(POLL_CURSOR_KEY)
+    end = now_millis()
+    if cursor is None:
+        params = {'relativeTime': time_option}
+        logging.info("Polling problems for %s%s with relativeTime '%s' (no previous poll)",
+                     TENANTS.current().host, API_ENDPOINT_PROBLEM_FEED, time_option)
+    else:
+        params = {'startTimestamp': cursor - POLL_INCREMENTAL_OVERLAP * 1000, 'endTimestamp': end}
+        logging.info("Polling problems for %s%s since %s",
+                     TENANTS.current().host, API_ENDPOINT_PROBLEM_FEED, get_timestamp_to_date(params['startTimestamp']))
+    try:
+        msg = "fetching the problem feed - " + API_ENDPOINT_PROBLEM_FEED
+        response = DT_CLIENT.get(API_ENDPOINT_PROBLEM_FEED, params=params, stream=True, lane='feed')
+        try:
+            handle_response_status(msg, response)
+            polled = 0
+            for problem_details in iter_feed_problems(response):
+                if not renew_lease():
+                    # The cursor is left to the process holding the lease now
+                    return
+                polled += 1
+                process_polled_problem_or_park(problem_details)
+        finally:
+            response.close()
+        STORE.set_value(POLL_CURSOR_KEY, end)
+        logging.info("There were %s problems found since the last poll", polled)
+    except Exception as e:
+        logging.error("There was an error polling the problems", exc_info=True)
     return
 
 
+# Owner of the leases taken by this process
+LEASE_OWNER = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+# Lease held by the task running in the thread: name, ttl and time it was last renewed
+HELD_LEASE = threading.local()
+
+
+# Runs the function only while this process holds the lease of the task, so with several
+# worker processes (or a poll daemon next to the webserver) only one of them runs it.
+# The lease is renewed on every run and while the function runs (see renew_lease), and
+# taken over by another process ttl seconds after the owner stopped renewing it.
+# run() returns False when the function was not run.
+def with_lease(name, function, ttl):
+    def run():
+        if STORE.acquire_lease(name, LEASE_OWNER, ttl):
+            HELD_LEASE.lease = [name, ttl, timeit.default_timer()]
+            try:
+                function()
+            finally:
+                HELD_LEASE.lease = None
+            return True
+        logging.debug("Task '%s' is run by another process", name)
+        return False
+    return run
+
+
+# Lease of the poll, renewed by the daemon every interval
+POLL_LEASE_TTL = 2 * (POLL_INTERVAL + POLL_JITTER)
+
+
+# One-shot poll of the poll command. It takes the lease of the scheduled poll, so it does not
+# run at the same time as the poll daemon, the webserver or another poll command (notifying the
+# same problems twice or moving the cursor of the incremental poll under them), and releases it.
+def run_poll_once(function, time_option):
+    if not with_lease('poll', lambda: function(time_option), POLL_LEASE_TTL)():
+        logging.warning("The poll is running in another process (poll --daemon, webserver or poll), try again later")
+        return
+    STORE.release_lease('poll', LEASE_OWNER)
+
+
+# Called by the tasks before each problem or parked work they process, so a run lasting longer
+# than the ttl keeps its lease (it is renewed once a quarter of the ttl has passed). Returns
+# False when another process took the lease over: the run must stop, the other process goes on.
+# Always True for a function run without a lease.
+def renew_lease():
+    lease = getattr(HELD_LEASE, 'lease', None)
+    if lease is None:
+        return True
+    name, ttl, renewed = lease
+    if timeit.default_timer() - renewed < ttl / 4.0:
+        return True
+    if STORE.acquire_lease(name, LEASE_OWNER, ttl):
+        lease[2] = timeit.default_timer()
+        return True
+    logging.warning("Lease of task '%s' taken over by another process, the run is stopped", name)
+    return False
+
+
+# Incremental poll run by the scheduler (poll --daemon or the webserver). It shares the
+# sent problems, caches and connections with the webhook handler of the same process.
+POLL_TASK = TenantProxy(TENANTS, 'poll_task')
+
+
+# The parked work is retried by a background task in the long running commands
+RETRY_TASK = TenantProxy(TENANTS, 'retry_task')
+
+
+# Run by the retry task: the old CLOSED problems are evicted from the sent problems of every
+# process (they are held in memory) even when no problem is sent, the parked work is
+# retried only by the process holding the lease
+def run_retry_task(retry):
+    PROBLEMS_SENT.evict()
+    retry()
+
+
+# Moves the old notifications and closed problems to the archive and deletes the expired segments
+def archive_payloads():
+    before = now_millis() - ARCHIVE_KEEP_DAYS * 86400 * 1000
+    received = ARCHIVE.archive_notifications(before)
+    sent = ARCHIVE.archive_problems(before)
+    pruned = ARCHIVE.prune()
+    if received or sent or pruned:
+        logging.info("%s notifications and %s problems archived in %s, %s expired segments deleted",
+                     received, sent, ARCHIVE.directory, pruned)
+
+
+ARCHIVE_TASK = TenantProxy(TENANTS, 'archive_task')
+
+
+# Prints the archived notifications and details of a problem number
+def print_archived_problem(problem_nr):
+    found = 0
+    for entry in ARCHIVE.find(problem_nr):
+        found += 1
+        print("{0}: {1}".format(get_timestamp_to_date(entry['time']), json.dumps(entry['record'])))
+    logging.info("%s archived records found for problem %s", found, problem_nr)
+
+
+# Flask app of the webserver, only imported by the commands serving HTTP. When this file
+# runs as a script it is registered as the webhook module first, so the webserver module
+# shares this configuration and state instead of importing a second copy of it.
+def get_app():
+    sys.modules.setdefault('webhook', sys.modules[__name__])
+    from webserver import app
+    return app
+
+
+# Background services of the webserver for all the tenants, started in every worker process
+def start_services():
+    for tenant in TENANTS:
+        tenant.ingest_queue.start()
+        start_tenant_tasks(tenant)
+        if POLL_IN_WEBSERVER:
+            tenant.poll_task.start()
+
+
+# Retries, archive and health checks of the co-process workers of the tenant
+def start_tenant_tasks(tenant):
+    tenant.retry_task.start()
+    tenant.archive_task.start()
+    if INCIDENT_COPROCESS:
+        tenant.incident_health_task.start()
+
+
+# Production server: waitress serves the requests with a pool of threads. For several
+# worker processes use a WSGI server with the wsgi.py module (e.g. gunicorn -w 4 wsgi:application).
+def run_production_server():
+    from waitress import serve
+    app = get_app()
+    logging.info("----------------------------------------------")
+    logging.info("\nStarting the webhook with waitress (%s threads)", SERVER_THREADS)
+    load_all_problems()
+    start_services()
+    serve(app, host=WEBHOOK_INTERFACE, port=WEBHOOK_PORT, threads=SERVER_THREADS,
+          connection_limit=SERVER_CONNECTION_LIMIT)
+
+
+def run_development_server():
+    app = get_app()
+    logging.info("----------------------------------------------")
+    logging.info("\nStarting the Flask Web Microservice")
+    load_all_problems()
+    start_services()
+    app.run(host=WEBHOOK_INTERFACE, port=WEBHOOK_PORT)
+
+
+def run_poll_daemon():
+    logging.info("----------------------------------------------")
+    logging.info("\nStarting the poll daemon, polling every %ss", POLL_INTERVAL)
+    load_all_problems()
+    # The default tenant is polled in this thread, the other tenants in their own threads
+    for tenant in TENANTS:
+        start_tenant_tasks(tenant)
+        if tenant is not TENANTS.default:
+            tenant.poll_task.start()
+    try:
+        TENANTS.default.poll_task.run_forever()
+    except KeyboardInterrupt:
+        logging.info("Poll daemon stopped")
+
+
 def persist_problem(problem_details):
-    check_create_dir(DIR_SENT)
-    filename = DIR_SENT + '/' + problem_details["displayName"] + '.json'
-    with open(filename, 'w') as f:
-        json.dump(problem_details, f)
+    with PERSIST_PROBLEM_TIME.time():
+        STORE.save_problem(problem_details)
+
+
+# Record of a sent problem. Evicted CLOSED problems are looked up in the database.
+def get_sent_problem(display_name):
+    record = PROBLEMS_SENT.get(display_name)
+    if record is None:
+        row = STORE.get_index_row(display_name)
+        if row is not None:
+            record = ProblemRecord(*row)
+    return record
 
 
+# Full details of a sent problem, read from the database
+def get_sent_problem_details(display_name):
+    return STORE.get_problem(display_name)
+
+
+# Sent problems and received notifications of the current tenant
 def load_problems():
-    global PROBLEMS_SENT
-    check_create_dir(DIR_SENT)
-    jsonfiles = [f for f in listdir(DIR_SENT) if isfile(join(DIR_SENT, f))]
-    for file in jsonfiles:
-        with open(DIR_SENT + '/' + file, 'r') as f:
-            problem_details = json.load(f)
-            PROBLEMS_SENT[problem_details["displayName"]] = problem_details
-            
+    PROBLEMS_SENT.put_all(ProblemRecord(*row) for row in STORE.load_index())
+    # Notifications received within the dedupe window before the start
+    since = now_millis() - DEDUPE_WINDOW * 1000
+    DEDUPE_INDEX.load((pid, state, received / 1000.0)
+                      for pid, state, received in STORE.load_notifications_index(since))
 
-def main():
-    
+
+def load_all_problems():
+    for tenant in TENANTS:
+        with tenant.activate():
+            load_problems()
+
+
+# True if the problem was already sent with the state of the notification or is already closed
+def is_sent_notification(problem_simple):
+    record = get_sent_problem(problem_simple['ProblemID'])
+    if record is None:
+        return False
+    return record.is_closed() or record.status == problem_simple['State']
+
+
+# Calls the integrations for a replayed notification with the current details of the problem,
+# unless its current status was already sent (e.g. by the replay of an earlier notification)
+def replay_notification(problem_simple):
+    try:
+        problem_details = get_problem_details(problem_simple['PID'], problem_simple['State'])
+        if is_new_problem(problem_details):
+            call_integration(problem_details['id'], problem_details=problem_details)
+    except Exception as e:
+        park_notification(problem_simple, e)
+
+
+# Calls the integrations again for the received notifications (e.g. after an outage of the
+# incident software), oldest first. The notifications are streamed from the database into a
+# bounded queue, so a large backlog is never loaded in memory. Notifications of problems
+# already sent with the same state are skipped; the failed ones are parked in the retry queue.
+# The notifications of one problem are replayed one after the other, so the OPEN and RESOLVED
+# notifications of a problem closed meanwhile call the integrations once, for CLOSED.
+def replay_notifications(received_from=None, received_to=None, dry_run=False, concurrency=REPLAY_CONCURRENCY):
+    logging.info("----------------------------------------------")
+    logging.info("Replaying %s notifications received from %s to %s%s",
+                 STORE.count_notifications(received_from, received_to),
+                 'the beginning' if received_from is None else get_timestamp_to_date(received_from),
+                 'now' if received_to is None else get_timestamp_to_date(received_to), ' (dry run)' if dry_run else '')
+    # PIDs being replayed by a worker
+    replaying = set()
+    condition = threading.Condition()
+
+    def replay(problem_simple):
+        with condition:
+            while problem_simple['PID'] in replaying:
+                condition.wait()
+            replaying.add(problem_simple['PID'])
+        try:
+            replay_notification(problem_simple)
+        finally:
+            with condition:
+                replaying.discard(problem_simple['PID'])
+                condition.notify_all()
+
+    replay_queue = WorkQueue('replay', TENANTS.current().bind(replay), concurrency, REPLAY_QUEUE_SIZE)
+    if not dry_run:
+        replay_queue.start()
+    # (PID, State) replayed, a notification delivered several times is replayed once
+    replayed = set()
+    skipped = 0
+    for received, problem_simple in STORE.iter_notifications(received_from, received_to):
+        if (not is_valid_notification(problem_simple) or "999" in problem_simple['ProblemID'] or
+                (problem_simple['PID'], problem_simple['State']) in replayed or
+                is_sent_notification(problem_simple)):
+            skipped += 1
+            continue
+        replayed.add((problem_simple['PID'], problem_simple['State']))
+        if dry_run:
+            logging.info("Notification %s (%s) received %s would be replayed",
+                         problem_simple['ProblemID'], problem_simple['State'], get_timestamp_to_date(received))
+        else:
+            replay_queue.submit(problem_simple, block=True)
+    if not dry_run:
+        replay_queue.join()
+        replay_queue.stop()
+        COMMENT_OUTBOX.flush()
+        SMS_DISPATCHER.flush()
+    logging.info("%s notifications %sreplayed, %s skipped (repeated or already sent), %s parked in the retry queue",
+                 len(replayed), 'would be ' if dry_run else '', skipped, RETRY_QUEUE.stats()['parked'])
+
+
+# Parses the options of the replay command. Returns False if they are not valid.
+def run_replay(args):
+    options = {}
+    args = list(args)
+    while args:
+        option = args.pop(0)
+        if option == '--dry-run':
+            options['dry_run'] = True
+        elif option in ('--from', '--to', '--concurrency') and args:
+            value = args.pop(0)
+            if option == '--concurrency':
+                if not value.isdigit() or int(value) < 1:
+                    return False
+                options['concurrency'] = int(value)
+            else:
+                millis = parse_replay_time(value)
+                if millis is None:
+                    return False
+                options['received_from' if option == '--from' else 'received_to'] = millis
+        else:
+            return False
+    replay_notifications(**options)
+    return True
+
+
+# Milliseconds of a UTC time in one of the REPLAY_TIME_FORMATS, None if it is not valid
+def parse_replay_time(value):
+    for time_format in REPLAY_TIME_FORMATS:
+        try:
+            return calendar.timegm(datetime.datetime.strptime(value, time_format).timetuple()) * 1000
+        except ValueError:
+            pass
+    return None
+
+
+# Imports the JSON files saved by previous versions in DIR_RECEIVED and DIR_SENT
+def migrate_problems():
+    logging.info("----------------------------------------------")
+    logging.info("Migrating '%s' and '%s' to %s", DIR_RECEIVED, DIR_SENT, STORE.filename)
+    received, sent = STORE.migrate(DIR_RECEIVED, DIR_SENT)
+    logging.info("%s notifications and %s problems imported. The directories can be deleted.", received, sent)
     load_problems()
+
+
+# Creates the components of a tenant and adds it to TENANTS. The settings are the name, tenant (URL),
+# api_token, username and password of the tenant and optionally its own store_file, archive_dir,
+# pool_size, rate_limit and rate_burst (of the API), ingest_workers, ingest_max_size and
+# incident_parallelism. The threads of the components run with the tenant as the current one.
+def add_tenant(settings):
+    name = settings['name']
+    tenant = Tenant(name, settings['tenant'], settings['api_token'], settings['username'], settings['password'])
+    # Every tenant has its own database (with its counters, leases and poll cursor) and archive
+    store_base, store_extension = os.path.splitext(STORE_FILE)
+    tenant.store = ProblemStore(settings.get('store_file', '{0}-{1}{2}'.format(store_base, name, store_extension)))
+    tenant.archive = SegmentArchive(settings.get('archive_dir', os.path.join(ARCHIVE_DIR, name)), tenant.store,
+                                    ARCHIVE_SEGMENT_MAX_BYTES, ARCHIVE_SEGMENT_MAX_AGE, ARCHIVE_RETENTION_DAYS * 86400)
+    
+    tenant.dt_target = create_target('dynatrace')
+    tenant.retry_queue = RetryQueue(tenant.store, RETRY_QUEUE_MAX_ATTEMPTS, RETRY_QUEUE_BASE_DELAY,
+                                    RETRY_QUEUE_MAX_DELAY)
+    tenant.retry_queue.register('notification', retry_notification)
+    tenant.retry_queue.register('polled_problem', retry_polled_problem)
+    tenant.retry_queue.register('comment', retry_comment)
+    tenant.retry_queue.register('sms', retry_sms)
+    tenant.dedupe_index = DedupeIndex(DEDUPE_WINDOW, DEDUPE_MAX_ENTRIES)
+    tenant.problems_sent = SentProblems(SENT_MAX_CLOSED, SENT_MAX_CLOSED_AGE)
+    tenant.problem_cache = TTLCache(PROBLEM_CACHE_MAX_ENTRIES, PROBLEM_CACHE_TTL)
+    tenant.row_cache = TTLCache(DASHBOARD_ROW_CACHE_SIZE, DASHBOARD_ROW_CACHE_TTL)
+    
+    # The rate limit of the API token is shared by the processes using the database of the tenant
+    rate_limit = settings.get('rate_limit', API_RATE_LIMIT)
+    rate_burst = settings.get('rate_burst', API_RATE_BURST)
+    tenant.api_governor = RateGovernor(rate_limit, rate_burst, API_LANES, API_RETRY_AFTER,
+                                       dict((lane, METRICS.histogram('webhook_api_rate_wait_seconds',
+                                                                     'Seconds waited for the API rate limit per lane',
+                                                                     {'lane': lane, 'tenant': name}))
+                                            for lane in API_LANES),
+                                       SharedBucket(tenant.store, 'dynatrace-api', rate_limit, rate_burst))
+    tenant.dt_client = DynatraceClient(tenant.host, tenant.api_token, settings.get('pool_size', API_POOL_SIZE),
+                                       API_CONNECT_TIMEOUT, API_READ_TIMEOUT, verify=verifyRequest(),
+                                       target=tenant.dt_target, governor=tenant.api_governor,
+                                       pool_timeout=API_POOL_TIMEOUT)
+    
+    tenant.ingest_queue = WorkQueue('ingest-' + name, tenant.bind(process_notification),
+                                    settings.get('ingest_workers', INGEST_WORKERS),
+                                    settings.get('ingest_max_size', INGEST_MAX_SIZE))
+    tenant.comment_outbox = CommentOutbox(tenant.bind(post_in_comments), COMMENTS_WINDOW, COMMENTS_MAX_ATTEMPTS,
+                                          COMMENTS_RETRY_DELAY, tenant.bind(park_comment),
+                                          settings.get('pool_size', API_POOL_SIZE), COMMENTS_MAX_PENDING)
+    # Post the pending comments before exiting, the ones still waiting are parked in the retry queue
+    atexit.register(tenant.comment_outbox.close, COMMENTS_WINDOW + COMMENTS_RETRY_DELAY)
+    tenant.sms_dispatcher = SmsDispatcher(SMS_TRANSPORT_CLIENT, SMS_RECIPIENTS, tenant.bind(get_sms_body),
+                                          SMS_DIGEST_WINDOW, SMS_DEDUPE_WINDOW, SMS_RATE_LIMIT,
+                                          tenant.bind(post_sms_result_in_problem_comments), TWILIO_TARGET,
+                                          tenant.bind(park_sms), SMS_SEND_TIME)
+    # Send the queued SMS before exiting (before the pending comments are posted), the ones
+    # still queued are parked in the retry queue
+    atexit.register(tenant.sms_dispatcher.close,
+                    SMS_DIGEST_WINDOW + tenant.sms_dispatcher.send_interval * len(SMS_RECIPIENTS))
+    
+    parallelism = settings.get('incident_parallelism', INCIDENT_PARALLELISM)
+    if INCIDENT_COPROCESS:
+        tenant.incident_pool = CoprocessPool(WORKER, parallelism, INCIDENT_TIMEOUT)
+        atexit.register(tenant.incident_pool.close)
+    else:
+        tenant.incident_pool = None
+    tenant.incident_executor = IncidentExecutor(EXECUTABLE, parallelism, INCIDENT_TIMEOUT, INCIDENT_BATCH_SIZE,
+                                                INCIDENT_TARGET, INCIDENT_CALL_TIME, tenant.incident_pool)
+    tenant.incident_health_task = PeriodicTask('incident-health-' + name,
+                                               lambda: tenant.incident_pool.check_health(), INCIDENT_HEALTH_INTERVAL)
+    
+    # Incremental poll run by the scheduler (poll --daemon or the webserver). It shares the
+    # sent problems, caches and connections with the webhook handler of the same process.
+    tenant.poll_task = PeriodicTask('poll-' + name, tenant.bind(
+        with_lease('poll', lambda: poll_new_problems(RELATIVETIMES[0]), POLL_LEASE_TTL)),
+        POLL_INTERVAL, POLL_JITTER)
+    retry = with_lease('retry-queue', lambda: tenant.retry_queue.drain(renew_lease), 2 * RETRY_QUEUE_INTERVAL)
+    tenant.retry_task = PeriodicTask('retry-queue-' + name, tenant.bind(lambda: run_retry_task(retry)),
+                                     RETRY_QUEUE_INTERVAL)
+    tenant.archive_task = PeriodicTask('archive-' + name, tenant.bind(
+        with_lease('archive', archive_payloads, 2 * ARCHIVE_INTERVAL)), ARCHIVE_INTERVAL)
+    
+    TENANTS.add(tenant)
+    return tenant
+
+
+# The default tenant keeps the database and archive directory of the configuration
+add_tenant({'name': DEFAULT_TENANT, 'tenant': TENANT_HOST, 'api_token': API_TOKEN, 'username': USERNAME,
+            'password': PASSWORD, 'store_file': STORE_FILE, 'archive_dir': ARCHIVE_DIR})
+for tenant_settings in TENANTS_CONFIG:
+    add_tenant(tenant_settings)
+
+
+# Queue depths, cache and component stats are read when the metrics are scraped
+def register_metrics():
+    METRICS.gauge('webhook_uptime_seconds', 'Seconds since the webhook was started',
+                  lambda: round(timeit.default_timer() - start_time, 3))
+    for tenant in TENANTS:
+        register_tenant_metrics(tenant)
+    for target in (TWILIO_TARGET, INCIDENT_TARGET):
+        register_target_metrics(target, {'target': target.name})
+    METRICS.gauge('webhook_log_queue_depth', 'Log records waiting to be written', lambda: LOG_PIPELINE.stats()['queued'])
+    METRICS.counter_function('webhook_log_dropped_total', 'Log records dropped because the log queue was full',
+                             lambda: LOG_PIPELINE.stats()['dropped'])
+
+
+# The metrics of the components of the tenant have the label tenant
+def register_tenant_metrics(tenant):
+    labels = {'tenant': tenant.name}
+    METRICS.counter_function('webhook_notifications_received_total', 'Notifications received in the webhook',
+                             lambda: tenant.store.get_counter(RECEIVED_COUNTER), labels)
+    for queue, depth in (('ingest', tenant.ingest_queue.depth), ('comments', tenant.comment_outbox.pending),
+                         ('sms', lambda: tenant.sms_dispatcher.stats()['queued']),
+                         ('retry', tenant.store.count_retries)):
+        METRICS.gauge('webhook_queue_depth', 'Items waiting in the queues', depth, dict(labels, queue=queue))
+    METRICS.counter_function('webhook_ingest_processed_total', 'Notifications processed by the ingest workers',
+                             lambda: tenant.ingest_queue.stats()['processed'], labels)
+    METRICS.counter_function('webhook_ingest_rejected_total', 'Notifications rejected with the ingest queue full',
+                             lambda: tenant.ingest_queue.stats()['rejected'], labels)
+    for name, cache in (('problem_details', tenant.problem_cache), ('dashboard_rows', tenant.row_cache)):
+        cache_labels = dict(labels, cache=name)
+        METRICS.gauge('webhook_cache_size', 'Entries in the caches', lambda cache=cache: len(cache), cache_labels)
+        METRICS.counter_function('webhook_cache_hits_total', 'Hits of the caches',
+                                 lambda cache=cache: cache.stats()['hits'], cache_labels)
+        METRICS.counter_function('webhook_cache_misses_total', 'Misses of the caches',
+                                 lambda cache=cache: cache.stats()['misses'], cache_labels)
+    METRICS.counter_function('webhook_duplicates_suppressed_total', 'Repeated notifications answered at once',
+                             lambda: tenant.dedupe_index.stats()['suppressed'], labels)
+    METRICS.gauge('webhook_sent_problems_tracked', 'Sent problems kept in memory',
+                  lambda: len(tenant.problems_sent), labels)
+    register_target_metrics(tenant.dt_target, dict(labels, target=tenant.dt_target.name))
+    if INCIDENT_COPROCESS:
+        METRICS.gauge('webhook_incident_workers_alive', 'Co-process workers of the Incident Software running',
+                      lambda: tenant.incident_pool.stats()['alive'], labels)
+        for reason in ('restarts', 'timeouts', 'lost', 'unhealthy'):
+            METRICS.counter_function('webhook_incident_worker_failures_total',
+                                     'Co-process workers of the Incident Software replaced per reason',
+                                     lambda reason=reason: tenant.incident_pool.stats()[reason],
+                                     dict(labels, reason=reason))
+    for lane in API_LANES:
+        METRICS.gauge('webhook_api_rate_waiting', 'Calls waiting for the API rate limit per lane',
+                      lambda lane=lane: tenant.api_governor.stats()['lanes'][lane]['waiting'], dict(labels, lane=lane))
+    METRICS.counter_function('webhook_api_throttled_total', 'Answers 429 (rate limit reached) of the Dynatrace API',
+                             lambda: tenant.api_governor.stats()['throttled'], labels)
+
+
+def register_target_metrics(target, labels):
+    METRICS.gauge('webhook_circuit_open', 'Whether the circuit of the target is open (1) or not (0)',
+                  lambda: target.stats()['state'] != 'closed', labels)
+    METRICS.counter_function('webhook_target_retries_total', 'Calls retried per target',
+                             lambda: target.stats()['retries'], labels)
+
+
+register_metrics()
+
+
+# The sent problems are only preloaded by the long-running commands (webserver and
+# poll daemon), the one-shot commands look up the few problems they need in the database.
+def main():
     
     logging.info("\nDynatrace Custom Webhook Integration")
+    # The commands run for the default tenant or the one given with --tenant <name>
+    # (the webserver and the poll daemon serve all the tenants)
+    tenant = TENANTS.default
+    if len(sys.argv) >= 3 and sys.argv[1] == "--tenant":
+        tenant = TENANTS.get(sys.argv[2])
+        del sys.argv[1:3]
+    if tenant is None:
+        logging.error("Unknown tenant, the tenants are: %s", ', '.join(t.name for t in TENANTS))
+        printUsage = True
+    else:
+        with tenant.activate():
+            printUsage = run_command()
+
+    if printUsage:
+        doUsage(sys.argv)
+    else:
+        print("Bye")
+    exit
+
+
+# Runs the command of the arguments. Returns True if the usage must be printed.
+def run_command():
     command = ""
     printUsage = False
     if len(sys.argv) >= 2:
         command = sys.argv[1]
         
         if command == "run":
-            logging.info("----------------------------------------------")
-            logging.info("\nStarting the Flask Web Microservice")
-            app.run(host=WEBHOOK_INTERFACE, port=WEBHOOK_PORT)
+            run_development_server()
+
+        elif command == "serve":
+            run_production_server()
 
         elif command == "poll":
             if len(sys.argv) == 3:
                 option = sys.argv[2]
                 if option in RELATIVETIMES:
-                    poll_problems(option)
+                    run_poll_once(poll_problems, option)
+                elif option == "incremental":
+                    run_poll_once(poll_new_problems, RELATIVETIMES[0])
+                elif option == "--daemon":
+                    run_poll_daemon()
                 else:
                     printUsage = True
 
             elif len(sys.argv) == 2:
-                poll_problems(RELATIVETIMES[0])
+                run_poll_once(poll_problems, RELATIVETIMES[0])
+            else:
+                printUsage = True
+
+        elif command == "migrate":
+            migrate_problems()
+
+        elif command == "archive":
+            if len(sys.argv) == 3:
+                print_archived_problem(sys.argv[2])
+            elif len(sys.argv) == 2:
+                archive_payloads()
             else:
                 printUsage = True
+
+        elif command == "replay":
+            printUsage = not run_replay(sys.argv[2:])
         else:
             printUsage = True
     else:
         printUsage = True
-
-    if printUsage:
-        doUsage(sys.argv)
-    else:
-        print("Bye")
-    exit
+    return printUsage
 
 
 def get_usage_as_string():
     return """
 Dynatrace Custom Webhook Integration
 =======================================================
-Usage: webhook.py <command> <options>
+Usage: webhook.py [--tenant <name>] <command> <options>
 commands: help = Prints this options
-commands: run  = Starts the WebServer.
+options: --tenant <name> before the command runs it for the tenant of tenants in config.json (default: the dynatrace
+         tenant). The webserver and the poll daemon serve all the tenants.
+commands: run  = Starts the WebServer (Flask development server).
+commands: serve = Starts the WebServer for production (waitress with the threads of server in config.json).
 commands: poll = Polls the Problems found in the API and calls the Incident Software. Default time hour.
 commands: poll <options>: relativeTime (optional) Possible values: hour, 2hours, 6hours, day, week, month
+commands: poll incremental: Polls only the problems since the last incremental poll (the first time the last hour).
+commands: poll --daemon: Keeps running and polls incrementally every interval seconds (see poll in config.json).
+commands: migrate = Imports the JSON files of the directories dir_received and dir_sent in the database.
+commands: archive = Moves the old notifications and closed problems to the archive now (see archive in config.json).
+commands: archive <problemNr> = Prints the archived notifications and details of the problem number.
+commands: replay <options> = Calls the integrations again for the received notifications, oldest first. Problems already
+          sent with the same state are skipped. Only the database is replayed, not the notifications archived after
+          keep_days (see archive in config.json). Options (optional): --from <time> --to <time> (UTC, e.g. 2018-05-01 or
+          2018-05-01T13:30), --concurrency <workers>, --dry-run (only lists the notifications that would be replayed).
 =======================================================
 """
 
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from flask import Flask, request, flash, render_template, abort
+from flask import Markup
+from flask_basicauth import BasicAuth
+import webhook
+
+#######################
+# Flask web microservice of the webhook.
+# It is only imported by the commands serving HTTP (run, serve and the
+# wsgi.py module), the other commands (poll, migrate, archive...) start
+# without loading Flask. The notifications and the dashboard are handled
+# by the webhook module, this module only adapts them to Flask and chooses
+# the tenant of each request.
+#######################
+
+# Initiate Flask Microservice with basic authentication
+app = Flask(__name__)
+app.secret_key = "super_secret_key"
+
+
+# The credentials of every tenant are valid. The notifications posted to / are handled for
+# the tenant of the credentials, the ones posted to /tenant/<name> for the tenant of the path.
+class TenantBasicAuth(BasicAuth):
+
+    def check_credentials(self, username, password):
+        return webhook.TENANTS.find_by_credentials(username, password) is not None
+
+
+# Protect your entire site with basic access authentication,
+# app.config['BASIC_AUTH_FORCE'] = True
+basic_auth = TenantBasicAuth(app)
+
+
+# Flask listener for POST Method with authorization
+@app.route('/', methods=['POST'])
+@basic_auth.required
+def handle_post():
+    auth = request.authorization
+    tenant = webhook.TENANTS.find_by_credentials(auth.username, auth.password)
+    with tenant.activate():
+        return webhook.receive_notification(request.data, request.remote_addr)
+
+
+# Flask listener for POST Method of a tenant, with the credentials of the tenant
+@app.route('/tenant/<name>', methods=['POST'])
+def handle_tenant_post(name):
+    tenant = get_tenant(name)
+    auth = request.authorization
+    if not auth or not tenant.is_authorized(auth.username, auth.password):
+        return basic_auth.challenge()
+    with tenant.activate():
+        return webhook.receive_notification(request.data, request.remote_addr)
+
+
+# Flask listener for GET Method
+# with public access
+@app.route('/', methods=['GET'])
+def handle_get():
+    return render_dashboard(webhook.TENANTS.default)
+
+
+@app.route('/tenant/<name>', methods=['GET'])
+def handle_tenant_get(name):
+    return render_dashboard(get_tenant(name))
+
+
+def render_dashboard(tenant):
+    time_option = request.args.get('relativeTime')
+    page = request.args.get('page', 1, type=int)
+    newest_first = request.args.get('order', 'newest') != 'oldest'
+    with tenant.activate():
+        for line in webhook.get_dashboard_lines(time_option, page, newest_first):
+            flash(Markup(line))
+    return render_template('index.html')
+
+
+def get_tenant(name):
+    tenant = webhook.TENANTS.get(name)
+    if tenant is None:
+        abort(404)
+    return tenant
+
+
+# Metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def handle_metrics():
+    return webhook.METRICS.render(), 200, {'Content-Type': webhook.METRICS_CONTENT_TYPE}
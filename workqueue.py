@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import timeit
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+#######################
+# Bounded in-process work queue served by a pool of worker threads.
+# Items are handed to the handler in FIFO order. When the queue is full
+# the submit is rejected so the caller can apply backpressure.
+#######################
+
+# Marker put in the queue to stop a worker thread
+_STOP = object()
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class WorkQueue(object):
+
+    def __init__(self, name, handler, workers, max_size):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.max_size = max_size
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.process_time_total = 0.0
+        self.process_time_max = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._work, name='{0}-{1}'.format(self.name, i))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        logging.info("Work queue '%s' started with %s workers and a capacity of %s", self.name, self.workers,
+                     self.max_size)
+
+    def stop(self):
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        for t in threads:
+            self._queue.put((timeit.default_timer(), _STOP))
+        for t in threads:
+            t.join()
+
+    # Puts an item in the queue. Raises QueueFullError when no slot is free
+    # (after waiting up to timeout seconds if block is set).
+    def submit(self, item, block=False, timeout=None):
+        try:
+            self._queue.put((timeit.default_timer(), item), block, timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError("Work queue '{0}' is full ({1} items)".format(self.name, self.max_size))
+        with self._lock:
+            self.enqueued += 1
+
+    # Blocks until every submitted item has been processed
+    def join(self):
+        self._queue.join()
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            enqueued_at, item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            started_at = timeit.default_timer()
+            failed = False
+            try:
+                self.handler(item)
+            except Exception:
+                failed = True
+                logging.error("There was an error processing an item of the work queue '%s'", self.name,
+                              exc_info=True)
+            finished_at = timeit.default_timer()
+            self._record(started_at - enqueued_at, finished_at - started_at, failed)
+            self._queue.task_done()
+
+    def _record(self, wait_time, process_time, failed):
+        with self._lock:
+            self.processed += 1
+            if failed:
+                self.failed += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+            self.process_time_total += process_time
+            self.process_time_max = max(self.process_time_max, process_time)
+
+    # Snapshot of the queue counters. Latencies are in seconds.
+    def stats(self):
+        with self._lock:
+            processed = self.processed
+            return {
+                'depth': self.depth(),
+                'max_size': self.max_size,
+                'workers': len(self._threads),
+                'enqueued': self.enqueued,
+                'processed': processed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'wait_avg': self.wait_time_total / processed if processed else 0.0,
+                'wait_max': self.wait_time_max,
+                'process_avg': self.process_time_total / processed if processed else 0.0,
+                'process_max': self.process_time_max,
+            }
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+import webhook
+
+#######################
+# WSGI entry point of the webhook for production servers with several
+# worker processes, e.g.
+#   gunicorn --workers 4 --threads 8 --bind 0.0.0.0:5000 wsgi:application
+# Every worker process loads the sent problems of all the tenants and starts its own
+# background services (do not preload the application before forking).
+# The workers share the state in the database of each tenant (store_file).
+#######################
+
+webhook.load_all_problems()
+webhook.start_services()
+
+application = webhook.get_app()